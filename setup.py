@@ -66,6 +66,7 @@ setup(
         'nti.zope_catalog',
         'setuptools',
         'six',
+        'transaction',
         'ZODB',
         'zope.annotation',
         'zope.component',
@@ -8,6 +8,13 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import six
+import itertools
+
+import transaction
+
+from BTrees.Length import Length
+
 from BTrees.OOBTree import OOBTree
 from BTrees.OOBTree import OOTreeSet
 
@@ -18,16 +25,23 @@ from zope import interface
 
 from zope.annotation import factory as an_factory
 
+from zope.annotation.interfaces import IAnnotations
+
 from zope.event import notify
 
+from zope.location import locate
+
 from zope.security.interfaces import IPrincipal
 
 from nti.dublincore.time_mixins import PersistentCreatedAndModifiedTimeObject
 
+from nti.containers.containers import LastModifiedBTreeContainer
 from nti.containers.containers import CaseInsensitiveCheckingLastModifiedBTreeContainer
 
 from nti.contenttypes.completion.completion import PrincipalCompletedItemContainer
 from nti.contenttypes.completion.completion import PrincipalAwardedCompletedItemContainer
+from nti.contenttypes.completion.completion import ExactKeyPrincipalCompletedItemContainer
+from nti.contenttypes.completion.completion import ExactKeyPrincipalAwardedCompletedItemContainer
 
 from nti.contenttypes.completion.interfaces import ICompletedItem
 from nti.contenttypes.completion.interfaces import IAwardedCompletedItem
@@ -36,8 +50,11 @@ from nti.contenttypes.completion.interfaces import IItemNTIIDAdapter
 from nti.contenttypes.completion.interfaces import IPrincipalAdapter
 from nti.contenttypes.completion.interfaces import ICompletionContext
 from nti.contenttypes.completion.interfaces import ICompletionTimeAdapter
+from nti.contenttypes.completion.interfaces import IItemSuccessAdapter
+from nti.contenttypes.completion.interfaces import IContextNTIIDAdapter
 from nti.contenttypes.completion.interfaces import ICompletedItemContainer
 from nti.contenttypes.completion.interfaces import IAwardedCompletedItemContainer
+from nti.contenttypes.completion.interfaces import IContextPrincipalAdapter
 from nti.contenttypes.completion.interfaces import ICompletableItemContainer
 from nti.contenttypes.completion.interfaces import IPrincipalCompletedItemContainer
 from nti.contenttypes.completion.interfaces import IPrincipalAwardedCompletedItemContainer
@@ -61,14 +78,117 @@ COMPLETION_CONTAINER_ANNOTATION_KEY = 'nti.contenttypes.completion.interfaces.IC
 logger = __import__('logging').getLogger(__name__)
 
 
-@component.adapter(ICompletionContext)
-@interface.implementer(ICompletedItemContainer)
-class CompletedItemContainer(CaseInsensitiveCheckingLastModifiedBTreeContainer,
-                             SchemaConfigured):
+class _CompletedItemContainerMixin(object):
     """
-    Stores mappings of username -> IPrincipalCompletedItemContainer for a user.
+    The behavior shared by the completed item container classes.
     """
-    createDirectFieldProperties(ICompletedItemContainer)
+
+    #: A mapping of lower-cased item ntiid -> set of principal container keys
+    #: that hold a :class:`ICompletedItem` for that item. Containers created
+    #: before this index existed have ``None`` here until
+    #: :meth:`rebuild_item_index` is called; until then lookups scan.
+    _item_index = None
+
+    #: Mappings of lower-cased item ntiid -> :class:`BTrees.Length.Length`
+    #: of successful and failed completions for that item. These are
+    #: created and rebuilt alongside ``_item_index``.
+    _success_counts = None
+    _failure_counts = None
+
+    #: The factory of the principal containers created in this container,
+    #: given the principal; the default principal container class if None.
+    #: Set it to e.g. :class:`.ConflictResolvingPrincipalCompletedItemContainer`
+    #: for contexts whose principals complete items concurrently.
+    principal_container_factory = None
+
+    def __init__(self):
+        super(_CompletedItemContainerMixin, self).__init__()
+        self._item_index = OOBTree()
+        self._success_counts = OOBTree()
+        self._failure_counts = OOBTree()
+
+    @staticmethod
+    def _get_item_key(item):
+        key = getattr(item, 'ntiid', item)
+        if not isinstance(key, six.string_types):
+            key = ''
+        return key.lower()
+
+    def _get_counts(self, completed_item):
+        if getattr(completed_item, 'Success', True):
+            return self._success_counts
+        return self._failure_counts
+
+    def _change_count(self, item_key, completed_item, delta):
+        counts = self._get_counts(completed_item)
+        if counts is None:
+            return
+        # Counters are never deleted, so concurrent updates to the same
+        # item only ever touch the (conflict-resolving) Length.
+        counter = counts.get(item_key)
+        if counter is None:
+            counter = counts[item_key] = Length()
+        counter.change(delta)
+
+    def _index_completed_item(self, principal_key, item_key, completed_item=None):
+        if self._item_index is None:
+            return
+        item_key = item_key.lower()
+        principal_keys = self._item_index.get(item_key)
+        if principal_keys is None:
+            principal_keys = self._item_index[item_key] = OOTreeSet()
+        if principal_keys.add(principal_key):
+            self._change_count(item_key, completed_item, 1)
+
+    def _unindex_completed_item(self, principal_key, item_key, completed_item=None):
+        if self._item_index is None:
+            return
+        item_key = item_key.lower()
+        principal_keys = self._item_index.get(item_key)
+        if principal_keys is not None and principal_key in principal_keys:
+            principal_keys.remove(principal_key)
+            self._change_count(item_key, completed_item, -1)
+            if not principal_keys:
+                del self._item_index[item_key]
+
+    def _setitemf(self, key, value):
+        super(_CompletedItemContainerMixin, self)._setitemf(key, value)
+        for item_key, completed_item in list(value.items()):
+            self._index_completed_item(key, item_key, completed_item)
+
+    def __delitem__(self, key):
+        user_container = self[key]
+        for item_key, completed_item in list(user_container.items()):
+            self._unindex_completed_item(key, item_key, completed_item)
+        super(_CompletedItemContainerMixin, self).__delitem__(key)
+
+    def rebuild_item_index(self):
+        """
+        (Re)build the item -> principal index from the stored principal
+        containers. Used to migrate containers created before the index
+        existed.
+        """
+        self._item_index = OOBTree()
+        self._success_counts = OOBTree()
+        self._failure_counts = OOBTree()
+        for principal_key, user_container in self.items():
+            for item_key, completed_item in user_container.items():
+                self._index_completed_item(principal_key, item_key, completed_item)
+
+    def _iter_user_containers(self, item):
+        """
+        Iterate the principal containers that (may) hold a completion for the
+        given item, using the item index when available.
+        """
+        if self._item_index is None:
+            for user_container in self.values():
+                yield user_container
+            return
+        principal_keys = self._item_index.get(self._get_item_key(item))
+        for principal_key in tuple(principal_keys or ()):
+            user_container = self.get(principal_key)
+            if user_container is not None:
+                yield user_container
 
     def get_completed_items(self, item):
         """
@@ -76,7 +196,7 @@ class CompletedItemContainer(CaseInsensitiveCheckingLastModifiedBTreeContainer,
         :class:`ICompletableItem`.
         """
         result = []
-        for user_container in self.values():
+        for user_container in self._iter_user_containers(item):
             completed_item = user_container.get_completed_item(item)
             if completed_item is not None:
                 result.append(completed_item)
@@ -87,7 +207,35 @@ class CompletedItemContainer(CaseInsensitiveCheckingLastModifiedBTreeContainer,
         Return the number of :class:`ICompletedItem` objects for the given
         :class:`ICompletableItem`.
         """
-        return len(self.get_completed_items(item))
+        if self._item_index is None:
+            return len(self.get_completed_items(item))
+        return self.get_success_count(item) + self.get_failure_count(item)
+
+    def _get_count(self, counts, item):
+        if counts is None:
+            return None
+        counter = counts.get(self._get_item_key(item))
+        return counter() if counter is not None else 0
+
+    def get_success_count(self, item):
+        """
+        Return the number of successful :class:`ICompletedItem` objects for
+        the given :class:`ICompletableItem`.
+        """
+        result = self._get_count(self._success_counts, item)
+        if result is None:
+            result = len([x for x in self.get_completed_items(item) if x.Success])
+        return result
+
+    def get_failure_count(self, item):
+        """
+        Return the number of unsuccessful :class:`ICompletedItem` objects for
+        the given :class:`ICompletableItem`.
+        """
+        result = self._get_count(self._failure_counts, item)
+        if result is None:
+            result = len([x for x in self.get_completed_items(item) if not x.Success])
+        return result
 
     def remove_item(self, item):
         """
@@ -95,11 +243,59 @@ class CompletedItemContainer(CaseInsensitiveCheckingLastModifiedBTreeContainer,
         :class:`ICompletableItem`.
         """
         count = 0
-        for user_container in self.values():
+        for user_container in list(self._iter_user_containers(item)):
             did_remove = user_container.remove_item(item)
             if did_remove:
                 count += 1
         return count
+
+    def _iter_principal_keys(self, item, cursor=None):
+        """
+        Iterate in order the keys of the principal containers that (may) hold
+        a completion for the given item, after the given cursor.
+        """
+        if self._item_index is None:
+            if cursor is None:
+                return iter(self.keys())
+            # Keys from the cursor on, in BTree order
+            return itertools.dropwhile(lambda x: x == cursor, self.keys(cursor))
+        principal_keys = self._item_index.get(self._get_item_key(item))
+        if principal_keys is None:
+            return iter(())
+        if cursor is None:
+            return iter(principal_keys.keys())
+        return iter(principal_keys.keys(cursor, excludemin=True))
+
+    def remove_item_in_batches(self, item, batch_size=1000, cursor=None,
+                               commit=True, checkpoint=None,
+                               transaction_manager=None):
+        """
+        Like :meth:`remove_item`, processing the principal containers that
+        hold the given :class:`ICompletableItem` in key order and in batches,
+        committing the transaction of the given (or the current) transaction
+        manager after each one.
+
+        :param cursor: The principal key after which to resume, as given to
+            the ``checkpoint`` callable after each batch.
+        :return: The number of :class:`ICompletedItem` objects removed.
+        """
+        manager = transaction_manager or transaction.manager
+        count = 0
+        while True:
+            keys = list(itertools.islice(self._iter_principal_keys(item, cursor),
+                                         batch_size))
+            if not keys:
+                break
+            for key in keys:
+                user_container = self.get(key)
+                if user_container is not None and user_container.remove_item(item):
+                    count += 1
+            cursor = keys[-1]
+            if commit:
+                manager.commit()
+            if checkpoint is not None:
+                checkpoint(cursor)
+        return count
     
     def remove_principal(self, user):
         """
@@ -117,7 +313,61 @@ class CompletedItemContainer(CaseInsensitiveCheckingLastModifiedBTreeContainer,
     def clear(self):
         for username in list(self.keys()):
             self.remove_principal(username)
-        super(CompletedItemContainer, self).clear()
+        super(_CompletedItemContainerMixin, self).clear()
+
+    def clear_batch(self, batch_size=1000):
+        """
+        Remove principals, without committing, until at least ``batch_size``
+        :class:`ICompletedItem` objects have been removed or none is left.
+
+        :return: The number of principals removed.
+        """
+        count = pending = 0
+        for username in list(itertools.islice(self.keys(), batch_size)):
+            if pending >= batch_size:
+                break
+            user_container = self.get(username)
+            if user_container is None:
+                continue
+            pending += len(user_container)
+            self.remove_principal(username)
+            count += 1
+        return count
+
+    def clear_in_batches(self, batch_size=1000, commit=True, checkpoint=None,
+                         transaction_manager=None):
+        """
+        Like :meth:`clear`, committing the transaction each time at least
+        ``batch_size`` :class:`ICompletedItem` objects have been removed.
+        An interrupted call is resumed by calling this method again.
+
+        :param checkpoint: A callable given the number of principals removed
+            so far after each commit.
+        :return: The number of principals removed.
+        """
+        manager = transaction_manager or transaction.manager
+        count = 0
+        while True:
+            removed = self.clear_batch(batch_size)
+            count += removed
+            if commit:
+                manager.commit()
+            if checkpoint is not None:
+                checkpoint(count)
+            if not removed or len(self) == 0:
+                break
+        return count
+
+
+@component.adapter(ICompletionContext)
+@interface.implementer(ICompletedItemContainer)
+class CompletedItemContainer(_CompletedItemContainerMixin,
+                             CaseInsensitiveCheckingLastModifiedBTreeContainer,
+                             SchemaConfigured):
+    """
+    Stores mappings of username -> IPrincipalCompletedItemContainer for a user.
+    """
+    createDirectFieldProperties(ICompletedItemContainer)
 
 _CompletedItemContainerFactory = an_factory(CompletedItemContainer,
                                             COMPLETED_ITEM_ANNOTATION_KEY)
@@ -134,6 +384,39 @@ _AwardedCompletedItemContainerFactory = an_factory(AwardedCompletedItemContainer
                                                    AWARDED_COMPLETED_ITEM_ANNOTATION_KEY)
 
 
+@component.adapter(ICompletionContext)
+@interface.implementer(ICompletedItemContainer)
+class ExactKeyCompletedItemContainer(_CompletedItemContainerMixin,
+                                     LastModifiedBTreeContainer,
+                                     SchemaConfigured):
+    """
+    A :class:`CompletedItemContainer` keyed by the exact principal ids,
+    holding :class:`.ExactKeyPrincipalCompletedItemContainer` objects.
+    Lookups and inserts neither normalize keys nor check constraints.
+    """
+    createDirectFieldProperties(ICompletedItemContainer)
+
+    principal_container_factory = ExactKeyPrincipalCompletedItemContainer
+
+_ExactKeyCompletedItemContainerFactory = an_factory(ExactKeyCompletedItemContainer,
+                                                    COMPLETED_ITEM_ANNOTATION_KEY)
+
+
+@component.adapter(ICompletionContext)
+@interface.implementer(IAwardedCompletedItemContainer)
+class ExactKeyAwardedCompletedItemContainer(ExactKeyCompletedItemContainer):
+    """
+    An :class:`AwardedCompletedItemContainer` keyed by the exact principal
+    ids.
+    """
+    createDirectFieldProperties(IAwardedCompletedItemContainer)
+
+    principal_container_factory = ExactKeyPrincipalAwardedCompletedItemContainer
+
+_ExactKeyAwardedCompletedItemContainerFactory = an_factory(ExactKeyAwardedCompletedItemContainer,
+                                                           AWARDED_COMPLETED_ITEM_ANNOTATION_KEY)
+
+
 @component.adapter(ICompletionContext)
 @interface.implementer(ICompletableItemContainer)
 class CompletableItemContainer(PersistentCreatedAndModifiedTimeObject,
@@ -143,10 +426,16 @@ class CompletableItemContainer(PersistentCreatedAndModifiedTimeObject,
     """
     createDirectFieldProperties(ICompletableItemContainer)
 
+    #: A :class:`BTrees.Length.Length` incremented whenever our required or
+    #: optional items change, so that our own record is not rewritten;
+    #: created on first change for existing containers.
+    _changes = None
+
     def __init__(self):
         super(CompletableItemContainer, self).__init__()
         self._required = OOBTree()
         self._optional = OOBTree()
+        self._changes = Length()
 
     def _get_item_key(self, item):
         try:
@@ -155,6 +444,25 @@ class CompletableItemContainer(PersistentCreatedAndModifiedTimeObject,
             key = item
         return key
 
+    def _get_key_sets(self):
+        """
+        Return frozen (required, optional) key sets. These are snapshotted
+        once per transaction and reset whenever we are mutated.
+        """
+        current = transaction.get()
+        key_sets = getattr(self, '_v_key_sets', None)
+        if key_sets is None or key_sets[0] is not current:
+            key_sets = self._v_key_sets = (current,
+                                           frozenset(self._required.keys()),
+                                           frozenset(self._optional.keys()))
+        return key_sets[1:]
+
+    def _state_changed(self):
+        self._v_key_sets = None
+        if self._changes is None:
+            self._changes = Length()
+        self._changes.change(1)
+
     def get_required_keys(self):
         return tuple(self._required.keys())
 
@@ -164,6 +472,7 @@ class CompletableItemContainer(PersistentCreatedAndModifiedTimeObject,
         """
         self.remove_optional_item(item)
         self._required[item.ntiid] = IWeakRef(item)
+        self._state_changed()
 
     def remove_required_item(self, item):
         """
@@ -172,6 +481,7 @@ class CompletableItemContainer(PersistentCreatedAndModifiedTimeObject,
         key = self._get_item_key(item)
         try:
             self._required.pop(key)
+            self._state_changed()
             result = True
         except KeyError:
             result = False
@@ -186,6 +496,7 @@ class CompletableItemContainer(PersistentCreatedAndModifiedTimeObject,
         """
         self.remove_required_item(item)
         self._optional[item.ntiid] = IWeakRef(item)
+        self._state_changed()
 
     def remove_optional_item(self, item):
         """
@@ -194,6 +505,7 @@ class CompletableItemContainer(PersistentCreatedAndModifiedTimeObject,
         key = self._get_item_key(item)
         try:
             self._optional.pop(key)
+            self._state_changed()
             result = True
         except KeyError:
             result = False
@@ -204,7 +516,7 @@ class CompletableItemContainer(PersistentCreatedAndModifiedTimeObject,
         Returns a bool if the given :class:`ICompletableItem` is required.
         """
         key = self._get_item_key(item)
-        return key in self._required
+        return key in self._get_key_sets()[0]
 
     def get_required_item_count(self):
         """
@@ -217,7 +529,7 @@ class CompletableItemContainer(PersistentCreatedAndModifiedTimeObject,
         Returns a bool if the given :class:`ICompletableItem` is optional.
         """
         key = self._get_item_key(item)
-        return key in self._optional
+        return key in self._get_key_sets()[1]
 
     def get_optional_item_count(self):
         """
@@ -228,6 +540,7 @@ class CompletableItemContainer(PersistentCreatedAndModifiedTimeObject,
     def clear(self):
         self._optional.clear()
         self._required.clear()
+        self._state_changed()
 
 _CompletableItemContainerFactory = an_factory(CompletableItemContainer,
                                               COMPLETABLE_ITEM_ANNOTATION_KEY)
@@ -270,16 +583,41 @@ class CompletableItemDefaultRequiredPolicy(PersistentCreatedAndModifiedTimeObjec
 
     creator = None
 
+    #: A :class:`BTrees.Length.Length` incremented whenever our mime types
+    #: change; created on first change for existing policies.
+    _changes = None
+
     def __init__(self, *args, **kwargs):
         super(CompletableItemDefaultRequiredPolicy, self).__init__(*args, **kwargs)
         self.mime_types = OOTreeSet()
+        self._changes = Length()
+
+    def get_mime_type_set(self):
+        """
+        Return a frozen set of our mime types, snapshotted once per
+        transaction and reset whenever they are changed through this object.
+        """
+        current = transaction.get()
+        mime_types = getattr(self, '_v_mime_types', None)
+        if mime_types is None or mime_types[0] is not current:
+            mime_types = self._v_mime_types = (current,
+                                               frozenset(self.mime_types))
+        return mime_types[1]
 
     def add_mime_types(self, mime_types):
         self.mime_types.update(mime_types)
+        self._mime_types_changed()
 
     def set_mime_types(self, mime_types):
         self.mime_types = OOTreeSet()
         self.mime_types.update(mime_types)
+        self._mime_types_changed()
+
+    def _mime_types_changed(self):
+        self._v_mime_types = None
+        if self._changes is None:
+            self._changes = Length()
+        self._changes.change(1)
 
 
 _CompletableItemDefaultRequiredFactory = an_factory(CompletableItemDefaultRequiredPolicy,
@@ -304,6 +642,66 @@ def AwardedCompletedItemContainerFactory(obj):
     return _create_annotation(obj, _AwardedCompletedItemContainerFactory)
 
 
+def ExactKeyCompletedItemContainerFactory(obj):
+    """
+    An opt-in alternative to :func:`CompletedItemContainerFactory` creating
+    :class:`ExactKeyCompletedItemContainer` objects. Existing containers
+    are converted with :func:`migrate_completed_item_containers`.
+    """
+    return _create_annotation(obj, _ExactKeyCompletedItemContainerFactory)
+
+
+def ExactKeyAwardedCompletedItemContainerFactory(obj):
+    """
+    An opt-in alternative to :func:`AwardedCompletedItemContainerFactory`
+    creating :class:`ExactKeyAwardedCompletedItemContainer` objects.
+    """
+    return _create_annotation(obj, _ExactKeyAwardedCompletedItemContainerFactory)
+
+
+def _migrate_completed_item_container(completion_context, annotations, key,
+                                      factory, principal_factory):
+    old = annotations.get(key)
+    if old is None or type(old) is factory:  # pylint: disable=unidiomatic-typecheck
+        return 0
+    new = factory()
+    annotations[key] = new
+    locate(new, completion_context, key)
+    principal_factory = new.principal_container_factory or principal_factory
+    for principal_key, old_principal in list(old.items()):
+        new_principal = principal_factory(old_principal.Principal)
+        new[principal_key] = new_principal
+        # Moving (rather than removing and re-adding) keeps the completed
+        # items' intids and catalog entries.
+        for item_key, completed_item in list(old_principal.items()):
+            new_principal[item_key] = completed_item
+    return len(new)
+
+
+def migrate_completed_item_containers(completion_context,
+                                      factory=ExactKeyCompletedItemContainer,
+                                      awarded_factory=ExactKeyAwardedCompletedItemContainer):
+    """
+    Replace the completed and awarded completed item containers of the
+    given :class:`ICompletionContext` by containers of the given classes,
+    moving every principal container and completed item into them.
+
+    :return: The number of principal containers migrated.
+    """
+    annotations = IAnnotations(completion_context, None)
+    if annotations is None:
+        return 0
+    result = _migrate_completed_item_container(completion_context, annotations,
+                                               COMPLETED_ITEM_ANNOTATION_KEY,
+                                               factory,
+                                               PrincipalCompletedItemContainer)
+    result += _migrate_completed_item_container(completion_context, annotations,
+                                                AWARDED_COMPLETED_ITEM_ANNOTATION_KEY,
+                                                awarded_factory,
+                                                PrincipalAwardedCompletedItemContainer)
+    return result
+
+
 def CompletableItemContainerFactory(obj):
     return _create_annotation(obj, _CompletableItemContainerFactory)
 
@@ -316,31 +714,129 @@ def CompletableItemDefaultRequiredFactory(obj):
     return _create_annotation(obj, _CompletableItemDefaultRequiredFactory)
 
 
-@component.adapter(IPrincipal, ICompletionContext)
-@interface.implementer(IPrincipalCompletedItemContainer)
-def _context_to_principal_container(user, completion_context):
-    completed_container = ICompletedItemContainer(completion_context)
+def detach_completed_item_containers(completion_context):
+    """
+    Remove the completed and awarded completed item containers from the
+    annotations of the given :class:`ICompletionContext`, without firing any
+    event, so that they can be drained (see
+    :meth:`CompletedItemContainer.clear_in_batches`) later.
+
+    :return: The list of detached containers.
+    """
+    result = []
+    annotations = IAnnotations(completion_context, None)
+    if annotations is None:
+        return result
+    for key in (COMPLETED_ITEM_ANNOTATION_KEY,
+                AWARDED_COMPLETED_ITEM_ANNOTATION_KEY):
+        container = annotations.get(key)
+        if container is not None:
+            del annotations[key]
+            result.append(container)
+    return result
+
+
+def _query_annotation(completion_context, key):
+    annotations = IAnnotations(completion_context, None)
+    return annotations.get(key) if annotations is not None else None
+
+
+def _principal_container_materializer(completion_context, container_iface,
+                                      user_id, principal_container):
+    def materialize():
+        completed_container = container_iface(completion_context)
+        completed_container[user_id] = principal_container
+    return materialize
+
+
+def _get_principal_container(user, completion_context, container_iface,
+                             annotation_key, factory, create=True):
     principal = IPrincipal(user)
     user_id = principal.id
-    try:
-        result = completed_container[user_id]
-    except KeyError:
-        result = PrincipalCompletedItemContainer(principal)
-        completed_container[user_id] = result
+    if create:
+        completed_container = container_iface(completion_context)
+    else:
+        completed_container = _query_annotation(completion_context,
+                                                annotation_key)
+    result = None
+    if completed_container is not None:
+        result = completed_container.get(user_id)
+        factory = getattr(completed_container, 'principal_container_factory',
+                          None) or factory
+    if result is None:
+        result = factory(principal)
+        if create:
+            completed_container[user_id] = result
+        else:
+            # Transient until something is actually added to it
+            # pylint: disable=protected-access
+            result._v_materialize = _principal_container_materializer(completion_context,
+                                                                      container_iface,
+                                                                      user_id,
+                                                                      result)
     return result
 
+
+def get_principal_completed_item_container(user, completion_context, create=True):
+    """
+    Return the :class:`IPrincipalCompletedItemContainer` for the user in the
+    given :class:`ICompletionContext`.
+
+    If `create` is False and the user does not have a container yet, an
+    empty container that is not stored is returned; it is stored in the
+    context's :class:`ICompletedItemContainer` only when an item is first
+    added to it. This avoids database writes on read paths.
+    """
+    return _get_principal_container(user, completion_context,
+                                    ICompletedItemContainer,
+                                    COMPLETED_ITEM_ANNOTATION_KEY,
+                                    PrincipalCompletedItemContainer,
+                                    create=create)
+
+
+def get_principal_awarded_completed_item_container(user, completion_context, create=True):
+    """
+    Return the :class:`IPrincipalAwardedCompletedItemContainer` for the user
+    in the given :class:`ICompletionContext`.
+
+    See :func:`get_principal_completed_item_container`.
+    """
+    return _get_principal_container(user, completion_context,
+                                    IAwardedCompletedItemContainer,
+                                    AWARDED_COMPLETED_ITEM_ANNOTATION_KEY,
+                                    PrincipalAwardedCompletedItemContainer,
+                                    create=create)
+
+
+@component.adapter(IPrincipal, ICompletionContext)
+@interface.implementer(IPrincipalCompletedItemContainer)
+def _context_to_principal_container(user, completion_context):
+    return get_principal_completed_item_container(user, completion_context)
+
+
 @component.adapter(IPrincipal, ICompletionContext)
 @interface.implementer(IPrincipalAwardedCompletedItemContainer)
 def _context_to_principal_awarded_container(user, completion_context):
-    completed_container = IAwardedCompletedItemContainer(completion_context)
-    principal = IPrincipal(user)
-    user_id = principal.id
-    try:
-        result = completed_container[user_id]
-    except KeyError:
-        result = PrincipalAwardedCompletedItemContainer(principal)
-        completed_container[user_id] = result
-    return result
+    return get_principal_awarded_completed_item_container(user, completion_context)
+
+
+#: The name of the (user, context) principal container adapters that do
+#: not store a missing container, for read paths.
+READ_ONLY_PRINCIPAL_CONTAINER_NAME = u'readonly'
+
+
+@component.adapter(IPrincipal, ICompletionContext)
+@interface.implementer(IPrincipalCompletedItemContainer)
+def _context_to_readonly_principal_container(user, completion_context):
+    return get_principal_completed_item_container(user, completion_context,
+                                                  create=False)
+
+
+@component.adapter(IPrincipal, ICompletionContext)
+@interface.implementer(IPrincipalAwardedCompletedItemContainer)
+def _context_to_readonly_principal_awarded_container(user, completion_context):
+    return get_principal_awarded_completed_item_container(user, completion_context,
+                                                          create=False)
 
 
 @component.adapter(ICompletionContext)
@@ -409,3 +905,39 @@ class _Success(object):
 @interface.implementer(ISuccessAdapter)
 def _completed_item_to_success(context):
     return _Success(context.Success)
+
+
+class _ContextPrincipal(object):
+
+    __slots__ = ('context_principal',)
+
+    def __init__(self, context_principal):
+        self.context_principal = context_principal
+
+
+@component.adapter(ICompletedItem)
+@interface.implementer(IContextPrincipalAdapter)
+def _completed_item_to_context_principal(context):
+    principal = IPrincipalAdapter(context, None)
+    context_ntiid = IContextNTIIDAdapter(context, None)
+    principal_id = getattr(principal, 'id', None)
+    context_ntiid = getattr(context_ntiid, 'ntiid', None)
+    if principal_id is None or context_ntiid is None:
+        return None
+    return _ContextPrincipal((context_ntiid, principal_id))
+
+
+class _ItemSuccess(object):
+
+    __slots__ = ('item_success',)
+
+    def __init__(self, item_success):
+        self.item_success = item_success
+
+
+@component.adapter(ICompletedItem)
+@interface.implementer(IItemSuccessAdapter)
+def _completed_item_to_item_success(context):
+    if context.ItemNTIID is None or context.Success is None:
+        return None
+    return _ItemSuccess((context.ItemNTIID, bool(context.Success)))
@@ -8,6 +8,10 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import time
+
+from persistent import Persistent
+
 from zope.container.contained import Contained
 
 from zope import interface
@@ -19,6 +23,7 @@ from nti.contenttypes.completion.interfaces import IAwardedCompletedItem
 from nti.contenttypes.completion.interfaces import IPrincipalCompletedItemContainer
 from nti.contenttypes.completion.interfaces import IPrincipalAwardedCompletedItemContainer
 
+from nti.containers.containers import LastModifiedBTreeContainer
 from nti.containers.containers import CaseInsensitiveCheckingLastModifiedBTreeContainer
 
 from nti.dataserver.sharing import AbstractReadableSharedMixin
@@ -38,19 +43,50 @@ from nti.wref.interfaces import IWeakRef
 logger = __import__('logging').getLogger(__name__)
 
 
-@interface.implementer(IPrincipalCompletedItemContainer)
-class PrincipalCompletedItemContainer(CaseInsensitiveCheckingLastModifiedBTreeContainer,
-                                      SchemaConfigured):
-    createDirectFieldProperties(IPrincipalCompletedItemContainer)
+class _PrincipalCompletedItemContainerMixin(object):
+    """
+    The behavior shared by the principal completed item container classes.
+    """
 
     user = alias('Principal')
     __parent__ = None
     __name__ = None
 
     def __init__(self, principal):
-        super(PrincipalCompletedItemContainer, self).__init__()
+        super(_PrincipalCompletedItemContainerMixin, self).__init__()
         self.Principal = IPrincipal(principal)
 
+    def _notify_parent(self, method_name, key, completed_item):
+        # Keep our context container's item index in sync, if we are
+        # located in one.
+        if self.__name__ is None:
+            return
+        method = getattr(self.__parent__, method_name, None)
+        if method is not None:
+            method(self.__name__, key, completed_item)
+
+    def _materialize(self):
+        # Containers handed out for read-only access are stored on their
+        # first write.
+        materialize = getattr(self, '_v_materialize', None)
+        if materialize is not None:
+            self._v_materialize = None
+            materialize()
+
+    def _setitemf(self, key, value):
+        self._materialize()
+        super(_PrincipalCompletedItemContainerMixin, self)._setitemf(key, value)
+        self._notify_parent('_index_completed_item', key, value)
+
+    def __delitem__(self, key):
+        completed_item = self[key]
+        super(_PrincipalCompletedItemContainerMixin, self).__delitem__(key)
+        self._notify_parent('_unindex_completed_item', key, completed_item)
+
+    def clear(self):
+        for key in list(self.keys()):
+            del self[key]
+
     def add_completed_item(self, completed_item):
         """
         Add a :class:`ICompletedItem` to the container.
@@ -86,11 +122,115 @@ class PrincipalCompletedItemContainer(CaseInsensitiveCheckingLastModifiedBTreeCo
         except KeyError:
             result = False
         return result
+
+
+@interface.implementer(IPrincipalCompletedItemContainer)
+class PrincipalCompletedItemContainer(_PrincipalCompletedItemContainerMixin,
+                                      CaseInsensitiveCheckingLastModifiedBTreeContainer,
+                                      SchemaConfigured):
+    createDirectFieldProperties(IPrincipalCompletedItemContainer)
+
     
 @interface.implementer(IPrincipalAwardedCompletedItemContainer)
 class PrincipalAwardedCompletedItemContainer(PrincipalCompletedItemContainer):
     
     createDirectFieldProperties(IPrincipalAwardedCompletedItemContainer)
+
+
+@interface.implementer(IPrincipalCompletedItemContainer)
+class ExactKeyPrincipalCompletedItemContainer(_PrincipalCompletedItemContainerMixin,
+                                              LastModifiedBTreeContainer,
+                                              SchemaConfigured):
+    """
+    A :class:`PrincipalCompletedItemContainer` keyed by the exact item
+    NTIIDs, without key normalization or per-insert constraint checks.
+    """
+    createDirectFieldProperties(IPrincipalCompletedItemContainer)
+
+
+@interface.implementer(IPrincipalAwardedCompletedItemContainer)
+class ExactKeyPrincipalAwardedCompletedItemContainer(ExactKeyPrincipalCompletedItemContainer):
+    """
+    A :class:`PrincipalAwardedCompletedItemContainer` keyed by the exact
+    item NTIIDs.
+    """
+    createDirectFieldProperties(IPrincipalAwardedCompletedItemContainer)
+
+
+class LastModifiedRegister(Persistent):
+    """
+    A persistent timestamp that only moves forward and resolves
+    conflicting writes to the greatest of their values.
+    """
+
+    value = 0
+
+    def __init__(self, value=0):
+        self.value = value
+
+    def __getstate__(self):
+        return self.value
+
+    def __setstate__(self, value):
+        self.value = value
+
+    def __call__(self):
+        return self.value
+
+    def set(self, value):
+        if value > self.value:
+            self.value = value
+        return self.value
+
+    def _p_resolveConflict(self, unused_old, committed, new):
+        return max(committed, new)
+
+
+class _ConflictResolvingContainerMixin(object):
+    """
+    Keeps the last modified time of a container in a
+    :class:`LastModifiedRegister`, so that adding or removing items does not
+    write the container record itself: concurrent writers only touch the
+    item BTree and the container's :class:`BTrees.Length.Length` counter,
+    both of which resolve conflicts.
+    """
+
+    _lastModifiedRegister = None
+
+    def _get_lastModified(self):
+        register = self._lastModifiedRegister
+        return register() if register is not None else 0
+
+    def _set_lastModified(self, value):
+        if self._lastModifiedRegister is None:
+            self._lastModifiedRegister = LastModifiedRegister()
+        self._lastModifiedRegister.set(value or 0)
+
+    lastModified = property(_get_lastModified, _set_lastModified)
+
+    def updateLastMod(self, t=None):
+        self.lastModified = t if t is not None else time.time()
+        return self.lastModified
+
+    def updateLastModIfGreater(self, t):
+        self.lastModified = t
+        return self.lastModified
+
+
+class ConflictResolvingPrincipalCompletedItemContainer(_ConflictResolvingContainerMixin,
+                                                       PrincipalCompletedItemContainer):
+    """
+    A :class:`PrincipalCompletedItemContainer` for principals completing
+    items in concurrent transactions.
+    """
+
+
+class ConflictResolvingPrincipalAwardedCompletedItemContainer(_ConflictResolvingContainerMixin,
+                                                              PrincipalAwardedCompletedItemContainer):
+    """
+    A :class:`PrincipalAwardedCompletedItemContainer` for principals
+    awarded items in concurrent transactions.
+    """
     
     
 class AbstractCompletedItem(Contained,
@@ -8,27 +8,66 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import time
+import weakref
+import itertools
+
 import BTrees
 
+from BTrees.Length import Length
+
+from persistent import Persistent
+
+import transaction
+
 from zope import component
 from zope import interface
 
+from zope.annotation.interfaces import IAnnotations
+
+from zope.catalog.interfaces import ICatalogIndex
+
+from zope.container.contained import Contained
+
+from zope.index.interfaces import IStatistics
+
+from zope.interface import providedBy
+
 from zope.intid.interfaces import IIntIds
 
 from zope.location import locate
 
+from zope.security.interfaces import IPrincipal
+
+from nti.contenttypes.completion.adapters import COMPLETED_ITEM_ANNOTATION_KEY
+from nti.contenttypes.completion.adapters import AWARDED_COMPLETED_ITEM_ANNOTATION_KEY
+
+from nti.contenttypes.completion.adapters import _completed_item_to_success
+from nti.contenttypes.completion.adapters import _completed_item_to_principal
+from nti.contenttypes.completion.adapters import _completed_item_to_item_ntiid
+from nti.contenttypes.completion.adapters import _completed_item_to_item_success
+from nti.contenttypes.completion.adapters import _completed_item_to_completion_time
+from nti.contenttypes.completion.adapters import _completed_item_to_context_principal
+
 from nti.contenttypes.completion.interfaces import ISiteAdapter
+from nti.contenttypes.completion.interfaces import ICompletedItem
 from nti.contenttypes.completion.interfaces import ISuccessAdapter
 from nti.contenttypes.completion.interfaces import IPrincipalAdapter
 from nti.contenttypes.completion.interfaces import IItemNTIIDAdapter
+from nti.contenttypes.completion.interfaces import IItemSuccessAdapter
 from nti.contenttypes.completion.interfaces import IContextNTIIDAdapter
 from nti.contenttypes.completion.interfaces import ICompletionTimeAdapter
+from nti.contenttypes.completion.interfaces import ICompletionContext
+from nti.contenttypes.completion.interfaces import IContextPrincipalAdapter
+
+from nti.contenttypes.completion.interfaces import get_completables
 
 from nti.zope_catalog.catalog import DeferredCatalog
 
 from nti.zope_catalog.datetime import TimestampNormalizer
 from nti.zope_catalog.datetime import TimestampToNormalized64BitIntNormalizer
 
+from nti.zope_catalog.index import ValueIndex
 from nti.zope_catalog.index import AttributeValueIndex
 from nti.zope_catalog.index import NormalizationWrapper
 from nti.zope_catalog.index import IntegerValueIndex as RawIntegerValueIndex
@@ -58,40 +97,213 @@ IX_COMPLETION_BY_DAY = 'completionByDay'
 #: Principal
 IX_USERNAME = IX_PRINCIPAL = 'principal'
 
+#: (Context ntiid, principal)
+IX_CONTEXT_PRINCIPAL = 'contextPrincipal'
+
+#: (Item ntiid, success)
+IX_ITEM_SUCCESS = 'itemSuccess'
+
 logger = __import__('logging').getLogger(__name__)
 
 
-class SiteIndex(AttributeValueIndex):
+class _IndexValueMixin(object):
+    """
+    Lets attribute value indexes index an already extracted field value.
+    """
+
+    def index_value(self, doc_id, value):
+        # The raw (non attribute) value index path
+        return ValueIndex.index_doc(self, doc_id, value)
+
+
+class SiteIndex(_IndexValueMixin, AttributeValueIndex):
     default_field_name = 'site'
     default_interface = ISiteAdapter
 
-
-class PrincipalIndex(AttributeValueIndex):
+    #: A :class:`BTrees.Length.Length` bumped whenever the site of a
+    #: document changes; created on first change for existing indexes.
+    changes = None
+
+    def _changed(self):
+        if self.changes is None:
+            self.changes = Length()
+        self.changes.change(1)
+
+    def index_doc(self, doc_id, value):
+        old = self.documents_to_values.get(doc_id)
+        result = super(SiteIndex, self).index_doc(doc_id, value)
+        if self.documents_to_values.get(doc_id) != old:
+            self._changed()
+        return result
+
+    def index_value(self, doc_id, value):
+        if value is None:
+            return self.unindex_doc(doc_id)
+        old = self.documents_to_values.get(doc_id)
+        result = super(SiteIndex, self).index_value(doc_id, value)
+        if value != old:
+            self._changed()
+        return result
+
+    def clear(self):
+        super(SiteIndex, self).clear()
+        self._changed()
+
+    def unindex_doc(self, doc_id):
+        indexed = doc_id in self.documents_to_values
+        result = super(SiteIndex, self).unindex_doc(doc_id)
+        if indexed:
+            self._changed()
+        return result
+
+
+class PrincipalIndex(_IndexValueMixin, AttributeValueIndex):
     default_field_name = 'id'
     default_interface = IPrincipalAdapter
 
 
-class ItemNTIIDIndex(AttributeValueIndex):
+class ItemNTIIDIndex(_IndexValueMixin, AttributeValueIndex):
     default_field_name = 'ntiid'
     default_interface = IItemNTIIDAdapter
 
 
-class ContextNTIIDIndex(AttributeValueIndex):
+class ContextNTIIDIndex(_IndexValueMixin, AttributeValueIndex):
     default_field_name = 'ntiid'
     default_interface = IContextNTIIDAdapter
 
 
-class SucessIndex(AttributeValueIndex):
+class ContextPrincipalIndex(_IndexValueMixin, AttributeValueIndex):
+    default_field_name = 'context_principal'
+    default_interface = IContextPrincipalAdapter
+
+
+class ItemSuccessIndex(_IndexValueMixin, AttributeValueIndex):
+    default_field_name = 'item_success'
+    default_interface = IItemSuccessAdapter
+
+
+class SucessIndex(_IndexValueMixin, AttributeValueIndex):
     default_field_name = 'success'
     default_interface = ISuccessAdapter
 
 
+class _SuccessDocuments(object):
+    """
+    A read-only docid -> success mapping view of a :class:`SuccessSetIndex`.
+    """
+
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+    def get(self, docid, default=None):
+        if docid in self.index._success:
+            return True
+        if docid in self.index._failure:
+            return False
+        return default
+
+    def __contains__(self, docid):
+        return self.get(docid) is not None
+
+    def __len__(self):
+        return self.index.documentCount()
+
+
+@interface.implementer(ICatalogIndex, IStatistics)
+class SuccessSetIndex(Persistent, Contained):
+    """
+    An alternative to :class:`SucessIndex` that only keeps the sets of
+    successful and failed docids, without a docid -> value mapping.
+
+    This saves the value index's reverse mapping; the two sets are the
+    same ``IF.TreeSet`` buckets as the value index's forward sets, so
+    memory for those and the cost of intersecting with them is unchanged.
+    """
+
+    default_field_name = 'success'
+    default_interface = ISuccessAdapter
+
+    def __init__(self, field_name=None, interface=None, family=BTrees.family64):
+        self.family = family
+        self.field_name = field_name or self.default_field_name
+        self.interface = interface or self.default_interface
+        self.clear()
+
+    def clear(self):
+        self._success = self.family.IF.TreeSet()
+        self._failure = self.family.IF.TreeSet()
+        self._num_docs = Length()
+
+    def documentCount(self):
+        return self._num_docs()
+
+    def wordCount(self):
+        return len(self.values_to_documents)
+
+    @property
+    def values_to_documents(self):
+        return {value: docids
+                for value, docids in ((True, self._success), (False, self._failure))
+                if docids}
+
+    @property
+    def documents_to_values(self):
+        return _SuccessDocuments(self)
+
+    def _value(self, obj):
+        if self.interface is not None:
+            obj = self.interface(obj, None)
+        return getattr(obj, self.field_name, None)
+
+    def index_doc(self, docid, obj):
+        return self.index_value(docid, self._value(obj))
+
+    def index_value(self, docid, value):
+        if value is None:
+            return self.unindex_doc(docid)
+        if value:
+            added, removed = self._success, self._failure
+        else:
+            added, removed = self._failure, self._success
+        moved = docid in removed
+        if moved:
+            removed.remove(docid)
+        if added.insert(docid) and not moved:
+            self._num_docs.change(1)
+
+    def unindex_doc(self, docid):
+        for docids in (self._success, self._failure):
+            if docid in docids:
+                docids.remove(docid)
+                self._num_docs.change(-1)
+
+    def apply(self, query):
+        if 'any_of' in query:
+            values = set(bool(x) for x in query['any_of'])
+        elif 'any' in query:
+            values = (True, False)
+        else:
+            raise ValueError('Unknown query type', query)
+        sets = [self._success if value else self._failure for value in values]
+        return self.family.IF.multiunion(sets)
+
+
 class CompletionTimeRawIndex(RawIntegerValueIndex):
     pass
 
 
+class CompletionTimeNormalizationWrapper(NormalizationWrapper):
+
+    def index_value(self, doc_id, value):
+        if value is None:
+            return self.unindex_doc(doc_id)
+        return self.index.index_doc(doc_id, self.normalizer.value(value))
+
+
 def CompletionTimeIndex(family=BTrees.family64):
-    return NormalizationWrapper(field_name='completionTime',
+    return CompletionTimeNormalizationWrapper(field_name='completionTime',
                                 interface=ICompletionTimeAdapter,
                                 index=CompletionTimeRawIndex(family=family),
                                 normalizer=TimestampToNormalized64BitIntNormalizer())
@@ -99,29 +311,144 @@ def CompletionTimeIndex(family=BTrees.family64):
 
 def CompletionByDayIndex(family=BTrees.family64):
     resolution = TimestampNormalizer.RES_DAY
-    return NormalizationWrapper(field_name='completionTime',
+    return CompletionTimeNormalizationWrapper(field_name='completionTime',
                                 interface=ICompletionTimeAdapter,
                                 index=CompletionTimeRawIndex(family=family),
                                 normalizer=TimestampToNormalized64BitIntNormalizer(resolution))
 
 
+#: adapter registry -> {provided: (generation, {(iface, field_name): extract})}
+_native_fields_cache = weakref.WeakKeyDictionary()
+
+
+class _CompletedItemFields(object):
+    """
+    Extracts the indexed fields of a completed item once, for all the
+    indexes of a :class:`CompletedItemCatalog`.
+    """
+
+    def __init__(self, item):
+        self.item = item
+        self._values = {}
+        self._natives = self._native_fields(providedBy(item))
+
+    @classmethod
+    def _native_fields(cls, provided):
+        """
+        Return the fields extracted directly for items providing the given
+        specification, those whose adapter is our own rather than a
+        registered override. Resolved once per adapter registry, until it
+        changes.
+        """
+        adapters = component.getSiteManager().adapters
+        generation = getattr(adapters, '_generation', None)
+        cache = _native_fields_cache.get(adapters)
+        if cache is None:
+            cache = _native_fields_cache[adapters] = {}
+        entry = cache.get(provided)
+        if entry is None or entry[0] != generation:
+            natives = {key: extract
+                       for key, (factory, extract) in cls._FIELDS.items()
+                       if adapters.lookup((provided,), key[0], u'') is factory}
+            entry = cache[provided] = (generation, natives)
+        return entry[1]
+
+    def _principal_id(self):
+        principal = IPrincipal(self.item.Principal, None)
+        return getattr(principal, 'id', None)
+
+    def _context_principal(self):
+        context_ntiid = self.value(IContextNTIIDAdapter, 'ntiid')
+        principal_id = self.value(IPrincipalAdapter, 'id')
+        if context_ntiid is None or principal_id is None:
+            return None
+        return (context_ntiid, principal_id)
+
+    def _item_success(self):
+        item = self.item
+        if item.ItemNTIID is None or item.Success is None:
+            return None
+        return (item.ItemNTIID, bool(item.Success))
+
+    _FIELDS = {
+        (IPrincipalAdapter, 'id'):
+            (_completed_item_to_principal, _principal_id),
+        (ISuccessAdapter, 'success'):
+            (_completed_item_to_success, lambda self: self.item.Success),
+        (IItemNTIIDAdapter, 'ntiid'):
+            (_completed_item_to_item_ntiid, lambda self: self.item.ItemNTIID),
+        (ICompletionTimeAdapter, 'completionTime'):
+            (_completed_item_to_completion_time,
+             lambda self: self.item.CompletedDate or None),
+        (IItemSuccessAdapter, 'item_success'):
+            (_completed_item_to_item_success, _item_success),
+        (IContextPrincipalAdapter, 'context_principal'):
+            (_completed_item_to_context_principal, _context_principal),
+    }
+
+    def value(self, iface, field_name):
+        key = (iface, field_name)
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        extract = self._natives.get(key)
+        if extract is not None:
+            value = extract(self)
+        else:
+            adapted = iface(self.item, None) if iface is not None else self.item
+            value = getattr(adapted, field_name, None)
+        self._values[key] = value
+        return value
+
+    def index(self, index, doc_id):
+        index_value = getattr(index, 'index_value', None)
+        if index_value is None or getattr(index, 'field_callable', False):
+            # e.g. the time indexes of existing catalogs
+            return index.index_doc(doc_id, self.item)
+        value = self.value(index.interface, index.field_name)
+        return index_value(doc_id, value)
+
+
 @interface.implementer(IDeferredCatalog)
 class CompletedItemCatalog(DeferredCatalog):
 
-    def force_index_doc(self, doc_id, obj):  # BWC
-        return super(CompletedItemCatalog, self).index_doc(doc_id, obj)
-
+    def index_doc(self, doc_id, obj):
+        """
+        Index completed items extracting each of their fields once, rather
+        than adapting them once per index.
+        """
+        if not ICompletedItem.providedBy(obj):
+            return super(CompletedItemCatalog, self).index_doc(doc_id, obj)
+        fields = _CompletedItemFields(obj)
+        for index in self.values():
+            fields.index(index, doc_id)
 
-def create_completed_item_catalog(catalog=None, family=BTrees.family64):
+    def force_index_doc(self, doc_id, obj):  # BWC
+        return self.index_doc(doc_id, obj)
+
+
+def _completed_item_indexes(success_index=SucessIndex):
+    return ((IX_SITE, SiteIndex),
+            (IX_SUCCESS, success_index),
+            (IX_PRINCIPAL, PrincipalIndex),
+            (IX_ITEM_NTIID, ItemNTIIDIndex),
+            (IX_CONTEXT_NTIID, ContextNTIIDIndex),
+            (IX_CONTEXT_PRINCIPAL, ContextPrincipalIndex),
+            (IX_ITEM_SUCCESS, ItemSuccessIndex),
+            (IX_COMPLETION_BY_DAY, CompletionByDayIndex),
+            (IX_COMPLETIONTIME, CompletionTimeIndex),)
+
+
+def create_completed_item_catalog(catalog=None, family=BTrees.family64,
+                                  success_index=SucessIndex):
+    """
+    :param success_index: The class of the success index, e.g.
+        :class:`SuccessSetIndex` for large catalogs.
+    """
     if catalog is None:
         catalog = CompletedItemCatalog(family=family)
-    for name, clazz in ((IX_SITE, SiteIndex),
-                        (IX_SUCCESS, SucessIndex),
-                        (IX_PRINCIPAL, PrincipalIndex),
-                        (IX_ITEM_NTIID, ItemNTIIDIndex),
-                        (IX_CONTEXT_NTIID, ContextNTIIDIndex),
-                        (IX_COMPLETION_BY_DAY, CompletionByDayIndex),
-                        (IX_COMPLETIONTIME, CompletionTimeIndex),):
+    for name, clazz in _completed_item_indexes(success_index):
         index = clazz(family=family)
         locate(index, catalog, name)
         catalog[name] = index
@@ -132,11 +459,155 @@ def get_completed_item_catalog(registry=component):
     return registry.queryUtility(IDeferredCatalog, name=COMPLETED_ITEM_CATALOG_NAME)
 
 
+def _indexing_key(item):
+    """
+    Return the (principal id, item NTIID) container key of a completed item.
+    """
+    principal = IPrincipal(getattr(item, 'Principal', None), None)
+    return (getattr(principal, 'id', None), getattr(item, 'ItemNTIID', None))
+
+
+class CompletedItemIndexingQueue(object):
+    """
+    A transaction-local queue of completed item catalog operations.
+
+    Operations are coalesced by the (principal, item NTIID) key of the
+    completed items: replacing the completed item of a key yields at most
+    an unindex of the previously committed item and an index of the last
+    one, and items both added and removed in the transaction are never
+    indexed. Operations are applied in docid order when the queue is
+    flushed, at the latest before commit.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        #: key -> {docid: (obj or None, added)}
+        self._pending = {}
+        #: docid -> key
+        self._keys = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _ops(self, doc_id, obj):
+        key = self._keys.get(doc_id)
+        if key is None:
+            key = self._keys[doc_id] = _indexing_key(obj) if obj is not None else None
+        return self._pending.setdefault(key, {})
+
+    def index_doc(self, doc_id, obj, added=False):
+        """
+        Queue the (re)indexing of the given object.
+
+        :param added: Whether the object was added in this transaction.
+        """
+        ops = self._ops(doc_id, obj)
+        previous = ops.get(doc_id)
+        added = added or (previous is not None and previous[1])
+        ops[doc_id] = (obj, added)
+
+    def unindex_doc(self, doc_id, obj=None):
+        """
+        Queue the unindexing of the given docid.
+        """
+        ops = self._ops(doc_id, obj)
+        previous = ops.get(doc_id)
+        if previous is not None and previous[1]:
+            # Never indexed
+            del ops[doc_id]
+            del self._keys[doc_id]
+        else:
+            ops[doc_id] = (None, False)
+
+    def flush(self):
+        while self._keys:
+            pending = {}
+            for ops in self._pending.values():
+                for doc_id, (obj, unused_added) in ops.items():
+                    pending[doc_id] = obj
+            self._pending = {}
+            self._keys = {}
+            for doc_id in sorted(pending):
+                obj = pending[doc_id]
+                if obj is None:
+                    self.catalog.unindex_doc(doc_id)
+                else:
+                    self.catalog.index_doc(doc_id, obj)
+
+
+#: transaction -> {id(catalog): queue}
+_indexing_queues = weakref.WeakKeyDictionary()
+
+
+def get_completed_item_indexing_queue(catalog=None, create=True):
+    """
+    Return the :class:`CompletedItemIndexingQueue` of the given (or the
+    registered) completed item catalog for the current transaction, or
+    None if there is no catalog.
+    """
+    catalog = get_completed_item_catalog() if catalog is None else catalog
+    if catalog is None:
+        return None
+    current = transaction.get()
+    queues = _indexing_queues.get(current)
+    if queues is None:
+        if not create:
+            return None
+        queues = _indexing_queues[current] = {}
+    queue = queues.get(id(catalog))
+    if queue is None and create:
+        queue = queues[id(catalog)] = CompletedItemIndexingQueue(catalog)
+        current.addBeforeCommitHook(queue.flush)
+    return queue
+
+
+def flush_completed_item_indexing_queue(catalog=None):
+    """
+    Apply the queued operations of the given (or the registered) completed
+    item catalog for the current transaction, if any.
+    """
+    queue = get_completed_item_indexing_queue(catalog, create=False)
+    if queue is not None:
+        queue.flush()
+
+
+def _add_missing_indexes(catalog, intids):
+    """
+    Add any index that is missing from an existing catalog.
+
+    The new indexes are left empty, and are not used by queries, until
+    populated with :func:`rebuild_completed_item_catalog`.
+    """
+    added = []
+    for name, clazz in _completed_item_indexes():
+        if name in catalog:
+            continue
+        index = clazz(family=intids.family)
+        index.populated = False
+        locate(index, catalog, name)
+        catalog[name] = index
+        intids.register(index)
+        added.append(name)
+        logger.warning('Added index %s to completed item catalog, run '
+                       'rebuild_completed_item_catalog(index_name=%r) to populate it',
+                       name, name)
+    return added
+
+
+def is_index_populated(catalog, name):
+    """
+    Return whether the given catalog index exists and is populated.
+    """
+    index = catalog.get(name)
+    return index is not None and getattr(index, 'populated', True)
+
+
 def install_completed_item_catalog(site_manager_container, intids=None):
     lsm = site_manager_container.getSiteManager()
     intids = lsm.getUtility(IIntIds) if intids is None else intids
     catalog = get_completed_item_catalog(registry=lsm)
     if catalog is not None:
+        _add_missing_indexes(catalog, intids)
         return catalog
 
     catalog = create_completed_item_catalog(family=intids.family)
@@ -149,3 +620,135 @@ def install_completed_item_catalog(site_manager_container, intids=None):
     for index in catalog.values():
         intids.register(index)
     return catalog
+
+
+#: The annotation keys of the completed item containers of a context, in
+#: the order they are (re)indexed.
+_COMPLETED_ITEM_ANNOTATION_KEYS = (COMPLETED_ITEM_ANNOTATION_KEY,
+                                   AWARDED_COMPLETED_ITEM_ANNOTATION_KEY)
+
+
+def _iter_principal_containers(context, after=None):
+    """
+    Yield, in order, the (annotation key, principal key) position and the
+    principal containers of the completed item containers of the given
+    context, after the given position if any.
+    """
+    annotations = IAnnotations(context, None)
+    if annotations is None:
+        return
+    keys = _COMPLETED_ITEM_ANNOTATION_KEYS
+    if after is not None:
+        keys = keys[keys.index(after[0]):]
+    for key in keys:
+        container = annotations.get(key)
+        if container is None:
+            continue
+        if after is not None and key == after[0]:
+            principal_keys = itertools.dropwhile(lambda x: x == after[1],
+                                                 container.keys(after[1]))
+        else:
+            principal_keys = container.keys()
+        for principal_key in list(principal_keys):
+            principal_container = container.get(principal_key)
+            if principal_container is not None:
+                yield (key, principal_key), principal_container
+
+
+def _sorted_completion_contexts():
+    """
+    Return the (NTIID, context) pairs of the completion contexts returned
+    by :func:`.get_completables`, sorted by NTIID.
+    """
+    result = []
+    for context in get_completables():
+        if not ICompletionContext.providedBy(context):
+            continue
+        ntiid = getattr(context, 'ntiid', None)
+        if not ntiid:
+            logger.warning('Cannot reindex completion context without NTIID %r',
+                           context)
+            continue
+        result.append((ntiid, context))
+    result.sort(key=lambda x: x[0])
+    return result
+
+
+def rebuild_completed_item_catalog(catalog=None, intids=None, index_name=None,
+                                   batch_size=1000, cursor=None, commit=True,
+                                   checkpoint=None, transaction_manager=None):
+    """
+    (Re)index the completed items of the completion contexts returned by
+    :func:`.get_completables`, in NTIID order.
+
+    Unless resuming, the catalog (or the given index) is cleared first, so
+    that stale documents are dropped. Work is committed each time at least
+    ``batch_size`` items have been indexed, and ``checkpoint(cursor,
+    items)`` is then called; pass the cursor back to resume an interrupted
+    rebuild.
+
+    Indexes added by :func:`install_completed_item_catalog` are marked as
+    populated once the rebuild completes.
+
+    :param index_name: Only (re)index the given catalog index.
+    :param cursor: The (context NTIID, annotation key, principal key)
+        position after which to resume.
+    :param commit: Whether to commit the transaction after each batch.
+    :return: A dict with the final ``cursor``, the number of ``contexts``
+        and ``items`` indexed and the ``elapsed`` seconds.
+    """
+    catalog = get_completed_item_catalog() if catalog is None else catalog
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    manager = transaction_manager or transaction.manager
+    indexes = list(catalog.values()) if index_name is None else [catalog[index_name]]
+    if index_name is None:
+        index_doc = getattr(catalog, 'force_index_doc', catalog.index_doc)
+    else:
+        index_doc = catalog[index_name].index_doc
+
+    if cursor is None:
+        for index in indexes:
+            index.clear()
+            # Not queried until rebuilt
+            index.populated = False
+
+    result = {'cursor': cursor, 'contexts': 0, 'items': 0, 'elapsed': 0}
+    started = time.time()
+
+    def batch_done():
+        if commit:
+            manager.commit()
+        result['elapsed'] = elapsed = time.time() - started
+        logger.info('Indexed %s completed item(s) in %s context(s) (%.2f items/s)',
+                    result['items'], result['contexts'],
+                    result['items'] / elapsed if elapsed else 0)
+        if checkpoint is not None:
+            checkpoint(result['cursor'], result['items'])
+
+    pending = 0
+    for ntiid, context in _sorted_completion_contexts():
+        after = None
+        if cursor is not None:
+            if ntiid < cursor[0]:
+                continue
+            if ntiid == cursor[0]:
+                after = cursor[1:]
+        for position, principal_container in _iter_principal_containers(context, after):
+            for item in list(principal_container.values()):
+                docid = intids.queryId(item)
+                if docid is None:
+                    continue
+                index_doc(docid, item)
+                pending += 1
+            result['cursor'] = (ntiid,) + position
+            if pending >= batch_size:
+                result['items'] += pending
+                pending = 0
+                batch_done()
+        result['contexts'] += 1
+    result['items'] += pending
+    for index in indexes:
+        if not getattr(index, 'populated', True):
+            index.populated = True
+    batch_done()
+    return result
@@ -443,6 +443,18 @@ class ICompletedItemContainer(IContainer):
         :class:`ICompletableItem`.
         """
 
+    def get_success_count(item):
+        """
+        Return the number of successful :class:`ICompletedItem` objects for
+        the given :class:`ICompletableItem`.
+        """
+
+    def get_failure_count(item):
+        """
+        Return the number of unsuccessful :class:`ICompletedItem` objects for
+        the given :class:`ICompletableItem`.
+        """
+
     def remove_principal(principal):
         """
         Remove all :class:`ICompletableItem` objects for the given
@@ -649,6 +661,20 @@ class IContextNTIIDAdapter(interface.Interface):
     ntiid = interface.Attribute("NTIID string")
 
 
+class IContextPrincipalAdapter(interface.Interface):
+    """
+    Adapts contained objects to their (context NTIID, principal id) pair.
+    """
+    context_principal = interface.Attribute("(context NTIID, principal id) tuple")
+
+
+class IItemSuccessAdapter(interface.Interface):
+    """
+    Adapts contained objects to their (item NTIID, success) pair.
+    """
+    item_success = interface.Attribute("(item NTIID, success) tuple")
+
+
 class ICompletables(interface.Interface):
     """
     A predicate to return completable objects
@@ -8,14 +8,29 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import transaction
+
+from BTrees.OOBTree import OOBTree
+
 from zope import component
 from zope import interface
 
+from zope.annotation.interfaces import IAnnotations
+
+from zope.component.hooks import getSite
+
 from zope.event import notify
 
+from zope.intid.interfaces import IIntIds
 from zope.intid.interfaces import IIntIdAddedEvent
+from zope.intid.interfaces import IIntIdRemovedEvent
 
 from zope.lifecycleevent.interfaces import IObjectAddedEvent
+from zope.lifecycleevent.interfaces import IObjectModifiedEvent
+
+from nti.contenttypes.completion.adapters import detach_completed_item_containers
+
+from nti.contenttypes.completion.index import get_completed_item_indexing_queue
 
 from nti.contenttypes.completion.interfaces import ICompletedItem
 from nti.contenttypes.completion.interfaces import ICompletableItem
@@ -23,10 +38,12 @@ from nti.contenttypes.completion.interfaces import ICompletedItemContainer
 from nti.contenttypes.completion.interfaces import IUserProgressRemovedEvent
 from nti.contenttypes.completion.interfaces import ICompletableItemContainer
 from nti.contenttypes.completion.interfaces import CompletedItemCreatedChangeEvent
+from nti.contenttypes.completion.interfaces import ICompletionContextCompletionPolicyUpdated
 from nti.contenttypes.completion.interfaces import ICompletionContextCompletionPolicyFactory
 from nti.contenttypes.completion.interfaces import ICompletionContextCompletionPolicyContainer
 
 from nti.contenttypes.completion.utils import update_completion
+from nti.contenttypes.completion.utils import invalidate_completable_items_cache
 
 from nti.coremetadata.interfaces import IUser
 
@@ -71,6 +88,109 @@ def completion_context_deleted_event(completion_context, unused_event=None):
             container.clear()
 
 
+#: The maximum number of completed items removed per transaction when
+#: draining detached completed item containers.
+DRAIN_BATCH_SIZE = 1000
+
+#: The site annotation key of the detached completed item containers
+#: still to be drained, by oid.
+PENDING_DRAIN_ANNOTATION_KEY = 'nti.contenttypes.completion.subscribers.PendingDrain'
+
+
+def _pending_drains(site, create=False):
+    annotations = IAnnotations(site, None) if site is not None else None
+    if annotations is None:
+        return None
+    result = annotations.get(PENDING_DRAIN_ANNOTATION_KEY)
+    if result is None and create:
+        result = annotations[PENDING_DRAIN_ANNOTATION_KEY] = OOBTree()
+    return result
+
+
+def _drain_container(site, oid, batch_size):
+    """
+    Drain the pending container with the given oid, removing each batch in
+    its own (retried) transaction of the current transaction manager.
+
+    :return: The number of principals removed.
+    """
+    count = 0
+    done = False
+    while not done:
+        for attempt in transaction.manager.attempts():
+            with attempt:
+                removed = 0
+                pending = _pending_drains(site)
+                # None if drained concurrently
+                container = pending.get(oid) if pending is not None else None
+                if container is not None:
+                    removed = container.clear_batch(batch_size)
+                    if not removed or len(container) == 0:
+                        del pending[oid]
+                        container = None
+                done = container is None
+        count += removed
+    return count
+
+
+def drain_pending_completed_item_containers(site=None, batch_size=DRAIN_BATCH_SIZE):
+    """
+    Drain the completed item containers detached by
+    :func:`completion_context_deleted_batched_event` in the given (or the
+    current) site. Meant to be run by the application, e.g. as a job
+    queue task or at startup; an interrupted drain is resumed by running
+    it again.
+
+    Each batch is committed with the current transaction manager, so this
+    must not be called with a transaction in progress.
+
+    :return: The number of containers drained.
+    """
+    site = getSite() if site is None else site
+    with transaction.manager:
+        pending = _pending_drains(site)
+        oids = list(pending.keys()) if pending is not None else ()
+    for oid in oids:
+        count = _drain_container(site, oid, batch_size)
+        logger.info('Drained %s principal(s) from detached container %r',
+                    count, oid)
+    return len(oids)
+
+
+def completion_context_deleted_batched_event(completion_context, unused_event=None):
+    """
+    An alternative to :func:`completion_context_deleted_event` for large
+    :class:`ICompletionContext` objects. The completed item containers are
+    detached from the context immediately and recorded in the annotations
+    of the current site, to be drained in transactions of bounded size by
+    :func:`drain_pending_completed_item_containers`, e.g. from a job queue
+    or at startup.
+    """
+    for clazz in (ICompletionContextCompletionPolicyContainer,
+                  ICompletableItemContainer):
+        container = clazz(completion_context, None)
+        if container:
+            # pylint: disable=too-many-function-args
+            container.clear()
+
+    site = getSite()
+    pending = None
+    for container in detach_completed_item_containers(completion_context):
+        oid = getattr(container, '_p_oid', None)
+        if oid is not None and pending is None:
+            pending = _pending_drains(site, create=True)
+        if oid is None or pending is None:
+            # Never committed (nothing to defer) or nowhere to record it
+            container.clear()
+        else:
+            pending[oid] = container
+
+
+@component.adapter(ICompletionContextCompletionPolicyUpdated)
+def _on_completion_policy_updated(event):
+    invalidate_completable_items_cache(event.completion_context)
+
+
 @component.adapter(ICompletedItem, IIntIdAddedEvent)
 def _on_completed_item_created(completed_item, unused_event=None):
     """
@@ -78,3 +198,37 @@ def _on_completed_item_created(completed_item, unused_event=None):
     user = IUser(completed_item.Principal)
     change = CompletedItemCreatedChangeEvent(completed_item, user)
     notify(TargetedStreamChangeEvent(change, user))
+
+
+def _completed_item_queue(completed_item):
+    """
+    Return the indexing queue and docid of the given completed item, if
+    both exist.
+    """
+    intids = component.queryUtility(IIntIds)
+    queue = get_completed_item_indexing_queue() if intids is not None else None
+    doc_id = intids.queryId(completed_item) if queue is not None else None
+    if doc_id is None:
+        return None, None
+    return queue, doc_id
+
+
+@component.adapter(ICompletedItem, IIntIdAddedEvent)
+def _queue_completed_item_added(completed_item, unused_event=None):
+    queue, doc_id = _completed_item_queue(completed_item)
+    if queue is not None:
+        queue.index_doc(doc_id, completed_item, added=True)
+
+
+@component.adapter(ICompletedItem, IObjectModifiedEvent)
+def _queue_completed_item_modified(completed_item, unused_event=None):
+    queue, doc_id = _completed_item_queue(completed_item)
+    if queue is not None:
+        queue.index_doc(doc_id, completed_item)
+
+
+@component.adapter(ICompletedItem, IIntIdRemovedEvent)
+def _queue_completed_item_removed(completed_item, unused_event=None):
+    queue, doc_id = _completed_item_queue(completed_item)
+    if queue is not None:
+        queue.unindex_doc(doc_id, completed_item)
@@ -27,9 +27,13 @@ import unittest
 
 from datetime import datetime
 
+from BTrees.OOBTree import OOBTree
+
 from ZODB.interfaces import IConnection
 
 from zope import component
+from zope.annotation.interfaces import IAnnotations
+
 from zope.component import eventtesting
 
 from zope.dublincore.interfaces import IWriteZopeDublinCore
@@ -40,8 +44,20 @@ from zope.lifecycleevent import IObjectRemovedEvent
 
 from zope.security.interfaces import IPrincipal
 
+from nti.contenttypes.completion.adapters import READ_ONLY_PRINCIPAL_CONTAINER_NAME
+from nti.contenttypes.completion.adapters import ExactKeyCompletedItemContainer
+from nti.contenttypes.completion.adapters import ExactKeyAwardedCompletedItemContainer
+from nti.contenttypes.completion.adapters import ExactKeyCompletedItemContainerFactory
+from nti.contenttypes.completion.adapters import get_principal_completed_item_container
+from nti.contenttypes.completion.adapters import migrate_completed_item_containers
+from nti.contenttypes.completion.adapters import detach_completed_item_containers
+from nti.contenttypes.completion.adapters import get_principal_awarded_completed_item_container
+
 from nti.contenttypes.completion.completion import CompletedItem
 from nti.contenttypes.completion.completion import AwardedCompletedItem
+from nti.contenttypes.completion.completion import LastModifiedRegister
+from nti.contenttypes.completion.completion import ExactKeyPrincipalCompletedItemContainer
+from nti.contenttypes.completion.completion import ConflictResolvingPrincipalCompletedItemContainer
 
 from nti.contenttypes.completion.interfaces import ICompletedItem
 from nti.contenttypes.completion.interfaces import IAwardedCompletedItem
@@ -57,6 +73,13 @@ from nti.contenttypes.completion.interfaces import ICompletionContextCompletionP
 from nti.contenttypes.completion.interfaces import IProgress
 from nti.contenttypes.completion.interfaces import UserProgressRemovedEvent
 
+from nti.contenttypes.completion.subscribers import PENDING_DRAIN_ANNOTATION_KEY
+from nti.contenttypes.completion.subscribers import drain_pending_completed_item_containers
+from nti.contenttypes.completion.subscribers import completion_context_deleted_batched_event
+
+from nti.contenttypes.completion.utils import get_completed_item
+from nti.contenttypes.completion.utils import get_awarded_completed_item
+
 from nti.contenttypes.completion.policies import AbstractCompletableItemCompletionPolicy
 from nti.contenttypes.completion.policies import CompletableItemAggregateCompletionPolicy
 
@@ -286,6 +309,427 @@ class TestCompletion(unittest.TestCase):
         assert_that(user_container2.get_completed_item_count(), is_(0))
         assert_that(user_container2.get_completed_item(completable2), none())
         
+    def test_readonly_principal_container(self):
+        """
+        Read-only lookups do not store principal containers until written.
+        """
+        now = datetime.utcnow()
+        user1 = MockUser(u'user1')
+        completable1 = MockCompletableItem(u'tag:nextthought.com,2011-10:NTI-TEST-completable1')
+        completion_context = MockCompletionContext()
+        # pylint: disable=too-many-function-args
+        user_container = get_principal_completed_item_container(user1,
+                                                                completion_context,
+                                                                create=False)
+        assert_that(user_container, has_length(0))
+        assert_that(user_container.__parent__, none())
+        assert_that(user_container.get_completed_item(completable1), none())
+        assert_that(user_container.remove_item(completable1), is_(False))
+
+        awarded_container = get_principal_awarded_completed_item_container(user1,
+                                                                           completion_context,
+                                                                           create=False)
+        assert_that(awarded_container, has_length(0))
+        assert_that(awarded_container.__parent__, none())
+
+        completed_container = ICompletedItemContainer(completion_context)
+        assert_that(completed_container, has_length(0))
+
+        # Through the registered read-only adapters
+        assert_that(get_completed_item(user1, completion_context, completable1),
+                    none())
+        assert_that(get_awarded_completed_item(user1, completion_context, completable1),
+                    none())
+        assert_that(completed_container, has_length(0))
+
+        # which can be overridden
+        override = fudge.Fake().provides('get_completed_item').returns('completed')
+        def factory(*unused_args):
+            return override
+        gsm = component.getGlobalSiteManager()
+        gsm.registerAdapter(factory, (MockUser, MockCompletionContext),
+                            IPrincipalCompletedItemContainer,
+                            READ_ONLY_PRINCIPAL_CONTAINER_NAME)
+        try:
+            assert_that(get_completed_item(user1, completion_context, completable1),
+                        is_('completed'))
+        finally:
+            gsm.unregisterAdapter(factory, (MockUser, MockCompletionContext),
+                                  IPrincipalCompletedItemContainer,
+                                  READ_ONLY_PRINCIPAL_CONTAINER_NAME)
+
+        # First write stores the container
+        user_container.add_completed_item(CompletedItem(Principal=user1,
+                                                        Item=completable1,
+                                                        CompletedDate=now))
+        assert_that(completed_container, has_length(1))
+        assert_that(completed_container[u'user1'], is_(user_container))
+        assert_that(completed_container.get_completed_item_count(completable1),
+                    is_(1))
+
+        # Existing containers are returned as-is
+        user_container_dupe = get_principal_completed_item_container(user1,
+                                                                     completion_context,
+                                                                     create=False)
+        assert_that(user_container_dupe, is_(user_container))
+
+    def test_completed_item_index(self):
+        """
+        Test the item -> principal index maintained by the context container.
+        """
+        now = datetime.utcnow()
+        user1 = MockUser(u'user1')
+        user2 = MockUser(u'user2')
+        completable1 = MockCompletableItem(u'tag:nextthought.com,2011-10:NTI-TEST-completable1')
+        completable2 = MockCompletableItem(u'tag:nextthought.com,2011-10:NTI-TEST-completable2')
+        completion_context = MockCompletionContext()
+        # pylint: disable=too-many-function-args
+        completed_container = ICompletedItemContainer(completion_context)
+        item_index = completed_container._item_index
+        assert_that(item_index, has_length(0))
+
+        user_container = component.queryMultiAdapter((user1, completion_context),
+                                                     IPrincipalCompletedItemContainer)
+        user_container2 = component.queryMultiAdapter((user2, completion_context),
+                                                      IPrincipalCompletedItemContainer)
+        # Viewing containers does not index anything
+        assert_that(item_index, has_length(0))
+
+        user_container.add_completed_item(CompletedItem(Principal=user1,
+                                                        Item=completable1,
+                                                        CompletedDate=now))
+        user_container2[completable1.ntiid] = CompletedItem(Principal=user2,
+                                                            Item=completable1,
+                                                            CompletedDate=now)
+        user_container2.add_completed_item(CompletedItem(Principal=user2,
+                                                         Item=completable2,
+                                                         CompletedDate=now))
+        assert_that(item_index, has_length(2))
+        assert_that(list(item_index[completable1.ntiid.lower()]),
+                    is_([u'user1', u'user2']))
+        assert_that(list(item_index[completable2.ntiid.lower()]),
+                    is_([u'user2']))
+        assert_that(completed_container.get_completed_items(completable1),
+                    has_length(2))
+
+        # Removal through the principal container
+        assert_that(user_container2.remove_item(completable1), is_(True))
+        assert_that(list(item_index[completable1.ntiid.lower()]),
+                    is_([u'user1']))
+        assert_that(completed_container.get_completed_item_count(completable1),
+                    is_(1))
+
+        # Removal through the context container
+        assert_that(completed_container.remove_item(completable1), is_(1))
+        assert_that(item_index, has_length(1))
+
+        # Removing a principal drops its entries
+        assert_that(completed_container.remove_principal(user2), is_(True))
+        assert_that(item_index, has_length(0))
+
+        # Legacy containers (without an index) scan and can be migrated
+        user_container.add_completed_item(CompletedItem(Principal=user1,
+                                                        Item=completable2,
+                                                        CompletedDate=now))
+        completed_container._item_index = None
+        assert_that(completed_container.get_completed_item_count(completable2),
+                    is_(1))
+        completed_container.rebuild_item_index()
+        assert_that(list(completed_container._item_index[completable2.ntiid.lower()]),
+                    is_([u'user1']))
+        assert_that(completed_container.get_completed_item_count(completable2),
+                    is_(1))
+
+    def test_completed_item_counts(self):
+        """
+        Test the per-item success/failure counters.
+        """
+        now = datetime.utcnow()
+        user1 = MockUser(u'user1')
+        user2 = MockUser(u'user2')
+        completable1 = MockCompletableItem(u'tag:nextthought.com,2011-10:NTI-TEST-completable1')
+        completion_context = MockCompletionContext()
+        # pylint: disable=too-many-function-args
+        completed_container = ICompletedItemContainer(completion_context)
+        assert_that(completed_container.get_success_count(completable1), is_(0))
+        assert_that(completed_container.get_failure_count(completable1), is_(0))
+
+        user_container = component.queryMultiAdapter((user1, completion_context),
+                                                     IPrincipalCompletedItemContainer)
+        user_container2 = component.queryMultiAdapter((user2, completion_context),
+                                                      IPrincipalCompletedItemContainer)
+        user_container.add_completed_item(CompletedItem(Principal=user1,
+                                                        Item=completable1,
+                                                        CompletedDate=now))
+        user_container2.add_completed_item(CompletedItem(Principal=user2,
+                                                         Item=completable1,
+                                                         CompletedDate=now,
+                                                         Success=False))
+        assert_that(completed_container.get_completed_item_count(completable1),
+                    is_(2))
+        assert_that(completed_container.get_success_count(completable1), is_(1))
+        assert_that(completed_container.get_failure_count(completable1), is_(1))
+        assert_that(completed_container.get_success_count(completable1.ntiid),
+                    is_(1))
+
+        user_container2.remove_item(completable1)
+        assert_that(completed_container.get_completed_item_count(completable1),
+                    is_(1))
+        assert_that(completed_container.get_failure_count(completable1), is_(0))
+
+        # Legacy containers fall back to counting the completed items
+        completed_container._item_index = None
+        completed_container._success_counts = None
+        completed_container._failure_counts = None
+        assert_that(completed_container.get_success_count(completable1), is_(1))
+        assert_that(completed_container.get_failure_count(completable1), is_(0))
+        completed_container.rebuild_item_index()
+        assert_that(completed_container.get_success_count(completable1), is_(1))
+
+    def test_conflict_resolving_principal_container(self):
+        register = LastModifiedRegister(10)
+        assert_that(register.set(5), is_(10))
+        assert_that(register.set(20), is_(20))
+        assert_that(register._p_resolveConflict(10, 30, 20), is_(30))
+        assert_that(register._p_resolveConflict(10, 20, 30), is_(30))
+
+        now = datetime.utcnow()
+        user1 = MockUser(u'user1')
+        completable1 = MockCompletableItem(u'tag:nextthought.com,2011-10:NTI-TEST-completable1')
+        completion_context = MockCompletionContext()
+        # pylint: disable=too-many-function-args
+        completed_container = ICompletedItemContainer(completion_context)
+        completed_container.principal_container_factory = \
+            ConflictResolvingPrincipalCompletedItemContainer
+        user_container = get_principal_completed_item_container(user1,
+                                                                completion_context)
+        assert_that(user_container,
+                    is_(ConflictResolvingPrincipalCompletedItemContainer))
+        assert_that(user_container, validly_provides(IPrincipalCompletedItemContainer))
+
+        user_container.lastModified = 0
+        user_container.add_completed_item(CompletedItem(Principal=user1,
+                                                        Item=completable1,
+                                                        CompletedDate=now))
+        assert_that(user_container, has_length(1))
+        last_modified = user_container.updateLastMod()
+        assert_that(last_modified, is_not(0))
+        assert_that(user_container.lastModified, is_(last_modified))
+        assert_that(user_container.__dict__, is_not(has_key('lastModified')))
+        # Time never goes backwards
+        user_container.updateLastMod(1)
+        assert_that(user_container.lastModified, is_(last_modified))
+        assert_that(completed_container.get_completed_items(completable1),
+                    has_length(1))
+
+    def test_exact_key_containers(self):
+        now = datetime.utcnow()
+        user1 = MockUser(u'user1')
+        user2 = MockUser(u'user2')
+        completable1 = MockCompletableItem(u'tag:nextthought.com,2011-10:NTI-TEST-completable1')
+        completable2 = MockCompletableItem(u'tag:nextthought.com,2011-10:NTI-TEST-completable2')
+
+        # Opt-in factory
+        completion_context = MockCompletionContext()
+        completed_container = ExactKeyCompletedItemContainerFactory(completion_context)
+        assert_that(completed_container, is_(ExactKeyCompletedItemContainer))
+        assert_that(completed_container, validly_provides(ICompletedItemContainer))
+        user_container = get_principal_completed_item_container(user1,
+                                                                completion_context)
+        assert_that(user_container, is_(ExactKeyPrincipalCompletedItemContainer))
+        assert_that(user_container, validly_provides(IPrincipalCompletedItemContainer))
+        user_container.add_completed_item(CompletedItem(Principal=user1,
+                                                        Item=completable1,
+                                                        CompletedDate=now))
+        assert_that(user_container.get_completed_item(completable1), not_none())
+        assert_that(user_container.get(completable1.ntiid.upper()), none())
+        assert_that(completed_container.get_completed_item_count(completable1),
+                    is_(1))
+
+        # Migration of existing containers
+        completion_context = MockCompletionContext()
+        # pylint: disable=too-many-function-args
+        completed_container = ICompletedItemContainer(completion_context)
+        completed_items = []
+        for user, item in ((user1, completable1), (user2, completable1), (user2, completable2)):
+            completed_item = CompletedItem(Principal=user, Item=item, CompletedDate=now)
+            component.queryMultiAdapter((user, completion_context),
+                                        IPrincipalCompletedItemContainer).add_completed_item(completed_item)
+            completed_items.append(completed_item)
+        awarded_container = IAwardedCompletedItemContainer(completion_context)
+        assert_that(awarded_container, has_length(0))
+
+        assert_that(migrate_completed_item_containers(completion_context), is_(2))
+        # pylint: disable=too-many-function-args
+        migrated = ICompletedItemContainer(completion_context)
+        assert_that(migrated, is_(ExactKeyCompletedItemContainer))
+        assert_that(migrated, has_length(2))
+        assert_that(migrated.__parent__, is_(completion_context))
+        assert_that(migrated['user2'], is_(ExactKeyPrincipalCompletedItemContainer))
+        assert_that(migrated.get_completed_items(completable1), has_length(2))
+        assert_that(migrated.get_completed_item_count(completable2), is_(1))
+        assert_that(migrated['user2'].get_completed_item(completable2),
+                    is_(completed_items[2]))
+        assert_that(completed_items[2].__parent__, is_(migrated['user2']))
+        assert_that(IAwardedCompletedItemContainer(completion_context),
+                    is_(ExactKeyAwardedCompletedItemContainer))
+        # Migrating again is a no-op
+        assert_that(migrate_completed_item_containers(completion_context), is_(0))
+
+    def test_remove_item_in_batches(self):
+        now = datetime.utcnow()
+        completable1 = MockCompletableItem(u'tag:nextthought.com,2011-10:NTI-TEST-completable1')
+        completable2 = MockCompletableItem(u'tag:nextthought.com,2011-10:NTI-TEST-completable2')
+        completion_context = MockCompletionContext()
+        # pylint: disable=too-many-function-args
+        completed_container = ICompletedItemContainer(completion_context)
+
+        def complete(*usernames):
+            for username in usernames:
+                user = MockUser(username)
+                container = get_principal_completed_item_container(user, completion_context)
+                container.add_completed_item(CompletedItem(Principal=user,
+                                                           Item=completable1,
+                                                           CompletedDate=now))
+        complete(u'user1', u'user2', u'user3')
+        get_principal_completed_item_container(
+            MockUser(u'user4'), completion_context).add_completed_item(
+                CompletedItem(Principal=MockUser(u'user4'),
+                              Item=completable2,
+                              CompletedDate=now))
+
+        checkpoints = []
+        count = completed_container.remove_item_in_batches(completable1,
+                                                           batch_size=2,
+                                                           commit=False,
+                                                           checkpoint=checkpoints.append)
+        assert_that(count, is_(3))
+        assert_that(checkpoints, is_([u'user2', u'user3']))
+        assert_that(completed_container.get_completed_items(completable1),
+                    has_length(0))
+        assert_that(completed_container.get_completed_items(completable2),
+                    has_length(1))
+
+        # Resuming after a cursor
+        complete(u'user1', u'user2', u'user3')
+        count = completed_container.remove_item_in_batches(completable1,
+                                                           cursor=u'user1',
+                                                           commit=False)
+        assert_that(count, is_(2))
+        assert_that(completed_container.get_completed_items(completable1),
+                    has_length(1))
+
+        # Legacy containers without an item index
+        completed_container._item_index = None
+        count = completed_container.remove_item_in_batches(completable1,
+                                                           batch_size=1,
+                                                           commit=False)
+        assert_that(count, is_(1))
+
+        # Resuming after a cursor, committing with the given manager
+        complete(u'user1', u'user2', u'user3')
+        commits = []
+        manager = fudge.Fake('manager').provides('commit').calls(lambda: commits.append(1))
+        count = completed_container.remove_item_in_batches(completable1,
+                                                           batch_size=1,
+                                                           cursor=u'user2',
+                                                           transaction_manager=manager)
+        assert_that(count, is_(1))
+        assert_that(commits, has_length(2))
+        assert_that(completed_container.get_completed_items(completable1),
+                    has_length(2))
+
+    def _complete_items(self, completion_context, count):
+        now = datetime.utcnow()
+        completable1 = MockCompletableItem(u'tag:nextthought.com,2011-10:NTI-TEST-completable1')
+        completable2 = MockCompletableItem(u'tag:nextthought.com,2011-10:NTI-TEST-completable2')
+        for idx in range(count):
+            user = MockUser(u'user%s' % idx)
+            container = get_principal_completed_item_container(user, completion_context)
+            for item in (completable1, completable2):
+                container.add_completed_item(CompletedItem(Principal=user,
+                                                           Item=item,
+                                                           CompletedDate=now))
+        return completable1
+
+    def test_clear_in_batches(self):
+        completion_context = MockCompletionContext()
+        completable1 = self._complete_items(completion_context, 5)
+        # pylint: disable=too-many-function-args
+        completed_container = ICompletedItemContainer(completion_context)
+        checkpoints = []
+        count = completed_container.clear_in_batches(batch_size=3,
+                                                     commit=False,
+                                                     checkpoint=checkpoints.append)
+        assert_that(count, is_(5))
+        assert_that(checkpoints, is_([2, 4, 5]))
+        assert_that(completed_container, has_length(0))
+        assert_that(completed_container.get_completed_item_count(completable1),
+                    is_(0))
+
+        # Detaching
+        completion_context = MockCompletionContext()
+        self._complete_items(completion_context, 2)
+        # pylint: disable=too-many-function-args
+        completed_container = ICompletedItemContainer(completion_context)
+        detached = detach_completed_item_containers(completion_context)
+        assert_that(detached, is_([completed_container]))
+        assert_that(completed_container, has_length(2))
+        assert_that(ICompletedItemContainer(completion_context), has_length(0))
+
+    def test_completion_context_deleted_batched_event(self):
+        completion_context = MockCompletionContext()
+        self._complete_items(completion_context, 2)
+        # pylint: disable=too-many-function-args
+        completed_container = ICompletedItemContainer(completion_context)
+        completion_context_deleted_batched_event(completion_context)
+        # Containers that were never committed are cleared right away
+        assert_that(completed_container, has_length(0))
+        assert_that(ICompletedItemContainer(completion_context),
+                    is_not(completed_container))
+
+    @fudge.patch('nti.contenttypes.completion.subscribers.getSite')
+    def test_completion_context_deleted_batched_drain(self, fake_site):
+        site = MockCompletionContext()
+        fake_site.is_callable().returns(site)
+        completion_context = MockCompletionContext()
+        self._complete_items(completion_context, 5)
+        # pylint: disable=too-many-function-args
+        completed_container = ICompletedItemContainer(completion_context)
+        # As if committed
+        completed_container._p_oid = b'\x00' * 7 + b'\x01'
+        completion_context_deleted_batched_event(completion_context)
+
+        # Detached and recorded, but not drained yet
+        assert_that(ICompletedItemContainer(completion_context),
+                    is_not(completed_container))
+        assert_that(completed_container, has_length(5))
+        pending = IAnnotations(site)[PENDING_DRAIN_ANNOTATION_KEY]
+        assert_that(pending, has_length(1))
+
+        # Drained in batches by the application
+        assert_that(drain_pending_completed_item_containers(batch_size=3),
+                    is_(1))
+        assert_that(completed_container, has_length(0))
+        assert_that(pending, has_length(0))
+
+    def test_drain_pending_completed_item_containers(self):
+        completion_context = MockCompletionContext()
+        self._complete_items(completion_context, 5)
+        # pylint: disable=too-many-function-args
+        completed_container = ICompletedItemContainer(completion_context)
+        assert_that(completed_container.clear_batch(batch_size=3), is_(2))
+        assert_that(completed_container, has_length(3))
+
+        site = MockCompletionContext()
+        pending = IAnnotations(site)[PENDING_DRAIN_ANNOTATION_KEY] = OOBTree()
+        pending[b'oid'] = completed_container
+        assert_that(drain_pending_completed_item_containers(site, batch_size=3),
+                    is_(1))
+        assert_that(completed_container, has_length(0))
+        assert_that(pending, has_length(0))
+        assert_that(drain_pending_completed_item_containers(site), is_(0))
+
     def test_awarded_completed(self):
         """
         Test manually awarding completed items
@@ -9,9 +9,11 @@ from __future__ import absolute_import
 
 from hamcrest import is_
 from hamcrest import none
+from hamcrest import not_none
 from hamcrest import is_not
 from hamcrest import contains
 from hamcrest import has_length
+from hamcrest import has_entries
 from hamcrest import assert_that
 from hamcrest import has_property
 from hamcrest import contains_inanyorder
@@ -25,30 +27,69 @@ import BTrees
 
 import fudge
 
+import transaction
+
 from zope import component
+from zope import interface
+
+from zope.intid.interfaces import IIntIds
+
+from nti.zope_catalog.datetime import TimestampNormalizer
 
 from nti.zope_catalog.interfaces import IDeferredCatalog
 
+from nti.contenttypes.completion.adapters import _NTIID
+
 from nti.contenttypes.completion.completion import CompletedItem
 
+from nti.contenttypes.completion.index import IX_SITE
 from nti.contenttypes.completion.index import IX_SUCCESS
 from nti.contenttypes.completion.index import IX_PRINCIPAL
 from nti.contenttypes.completion.index import IX_ITEM_NTIID
 from nti.contenttypes.completion.index import IX_COMPLETIONTIME
+from nti.contenttypes.completion.index import IX_ITEM_SUCCESS
+from nti.contenttypes.completion.index import IX_CONTEXT_PRINCIPAL
 
 from nti.contenttypes.completion.index import COMPLETED_ITEM_CATALOG_NAME
 
 from nti.contenttypes.completion.index import create_completed_item_catalog
 from nti.contenttypes.completion.index import install_completed_item_catalog
+from nti.contenttypes.completion.index import is_index_populated
+from nti.contenttypes.completion.index import rebuild_completed_item_catalog
+from nti.contenttypes.completion.index import get_completed_item_indexing_queue
 
+from nti.contenttypes.completion.index import SuccessSetIndex
 from nti.contenttypes.completion.index import CompletedItemCatalog
 
+from nti.contenttypes.completion.interfaces import ISiteAdapter
+from nti.contenttypes.completion.interfaces import ICompletables
+from nti.contenttypes.completion.interfaces import ICompletedItem
+from nti.contenttypes.completion.interfaces import IItemNTIIDAdapter
+from nti.contenttypes.completion.interfaces import IContextNTIIDAdapter
+
 from nti.contenttypes.completion.tests.test_models import MockUser
 from nti.contenttypes.completion.tests.test_models import MockCompletableItem
+from nti.contenttypes.completion.tests.test_models import MockCompletionContext
 
 from nti.contenttypes.completion.tests import SharedConfiguringTestLayer
 
+from nti.contenttypes.completion import utils
+
+from nti.contenttypes.completion.adapters import COMPLETED_ITEM_ANNOTATION_KEY
+
+from nti.contenttypes.completion.adapters import get_principal_completed_item_container
+
+from nti.contenttypes.completion.subscribers import _queue_completed_item_added
+from nti.contenttypes.completion.subscribers import _queue_completed_item_removed
+
 from nti.contenttypes.completion.utils import get_indexed_completed_items
+from nti.contenttypes.completion.utils import get_indexed_completion_histogram
+from nti.contenttypes.completion.utils import iter_indexed_completed_items
+from nti.contenttypes.completion.utils import get_sorted_indexed_completed_items_intids
+from nti.contenttypes.completion.utils import count_indexed_completed_items
+from nti.contenttypes.completion.utils import count_indexed_completed_items_by_item
+from nti.contenttypes.completion.utils import count_indexed_completed_items_by_success
+from nti.contenttypes.completion.utils import count_indexed_completed_items_by_principal
 from nti.contenttypes.completion.utils import get_indexed_completed_items_intids
 
 
@@ -68,7 +109,7 @@ class TestIndex(unittest.TestCase):
         catalog = create_completed_item_catalog(family=BTrees.family64)
         assert_that(isinstance(catalog, CompletedItemCatalog),
                     is_(True))
-        assert_that(catalog, has_length(7))
+        assert_that(catalog, has_length(9))
 
         # test index
         one_day_ago = now - timedelta(days=1)
@@ -148,9 +189,635 @@ class TestIndex(unittest.TestCase):
                                                 catalog=catalog)
         assert_that(rs, contains_inanyorder(2, 3, 1))
 
+    def _make_catalog(self, now=None, **kwargs):
+        now = datetime.utcnow() if now is None else now
+        user1 = MockUser(u'user1')
+        user2 = MockUser(u'user2')
+        completable1 = MockCompletableItem('completable1')
+        completable2 = MockCompletableItem('completable2')
+        catalog = create_completed_item_catalog(family=BTrees.family64, **kwargs)
+        for docid, (user, item, success) in enumerate(((user1, completable1, True),
+                                                       (user1, completable2, False),
+                                                       (user2, completable1, True),
+                                                       (user2, completable2, True)),
+                                                      start=1):
+            completed = CompletedItem(Principal=user,
+                                      Item=item,
+                                      CompletedDate=now - timedelta(days=docid),
+                                      Success=success)
+            catalog.force_index_doc(docid, completed)
+        return catalog
+
+    def test_count_indexed_completed_items(self):
+        catalog = self._make_catalog()
+        assert_that(count_indexed_completed_items(users=('user1', 'user2'),
+                                                  catalog=catalog),
+                    is_(4))
+        assert_that(count_indexed_completed_items(items='completable1',
+                                                  success=True,
+                                                  catalog=catalog),
+                    is_(2))
+        assert_that(count_indexed_completed_items(users='user1',
+                                                  sites='unknown',
+                                                  catalog=catalog),
+                    is_(0))
+
+        counts = count_indexed_completed_items_by_item(users=('user1', 'user2'),
+                                                       catalog=catalog)
+        assert_that(counts, is_({'completable1': 2, 'completable2': 2}))
+
+        counts = count_indexed_completed_items_by_item(users='user1',
+                                                       catalog=catalog)
+        assert_that(counts, is_({'completable1': 1, 'completable2': 1}))
+
+        counts = count_indexed_completed_items_by_principal(success=True,
+                                                            catalog=catalog)
+        assert_that(counts, has_entries('user1', 1, 'user2', 2))
+
+        counts = count_indexed_completed_items_by_principal(users='user3',
+                                                            catalog=catalog)
+        assert_that(counts, is_({}))
+
+    def test_count_indexed_completed_items_paths(self):
+        catalog = self._make_catalog()
+        counts = count_indexed_completed_items_by_principal(catalog=catalog,
+                                                            min_time=0)
+        # Counting per document gives the same results
+        patch = fudge.patch_object(utils, '_INTERSECT_MAX_VALUES', 0)
+        try:
+            assert_that(count_indexed_completed_items_by_principal(catalog=catalog,
+                                                                   min_time=0),
+                        is_(counts))
+        finally:
+            patch.restore()
+        assert_that(counts, is_({'user1': 2, 'user2': 2}))
+
+    def test_iter_indexed_completed_items(self):
+        catalog = self._make_catalog()
+        intids = fudge.Fake().provides('queryObject').calls(lambda x: x)
+        # Only completed items are returned
+        items = list(iter_indexed_completed_items(users=('user1', 'user2'),
+                                                  catalog=catalog,
+                                                  intids=intids))
+        assert_that(items, has_length(0))
+
+        completed = CompletedItem(Principal=MockUser(u'user1'),
+                                  Item=MockCompletableItem('completable1'),
+                                  CompletedDate=datetime.utcnow())
+        loaded = []
+        def query_object(docid):
+            loaded.append(docid)
+            return completed
+        intids = fudge.Fake().provides('queryObject').calls(query_object)
+        items = iter_indexed_completed_items(users=('user1', 'user2'),
+                                             catalog=catalog,
+                                             intids=intids,
+                                             batch_size=3)
+        assert_that(next(items), is_(completed))
+        assert_that(loaded, contains(1, 2, 3))
+        assert_that(list(items), has_length(3))
+        assert_that(loaded, contains(1, 2, 3, 4))
+
+        del loaded[:]
+        items = iter_indexed_completed_items(users=('user1', 'user2'),
+                                             catalog=catalog,
+                                             intids=intids,
+                                             offset=1,
+                                             limit=2)
+        assert_that(list(items), has_length(2))
+        assert_that(loaded, contains(2, 3))
+
+    def test_iter_indexed_completed_items_prefetch(self):
+        catalog = self._make_catalog()
+        events = []
+
+        class Ghost(object):
+            _p_jar = None
+
+            def __getattribute__(self, name):
+                if not name.startswith('_p_'):
+                    events.append('load')
+                return object.__getattribute__(self, name)
+
+        @interface.implementer(ICompletedItem)
+        class CompletedGhost(Ghost):
+            pass
+
+        connection = fudge.Fake('connection')
+        connection.provides('prefetch').calls(
+            lambda objects: events.append(('prefetch', len(list(objects)))))
+        ghosts = {}
+        for docid in range(1, 5):
+            ghost = CompletedGhost() if docid != 2 else Ghost()
+            ghost._p_jar = connection
+            ghosts[docid] = ghost
+        intids = fudge.Fake().provides('queryObject').calls(ghosts.get)
+        items = list(iter_indexed_completed_items(users=('user1', 'user2'),
+                                                  catalog=catalog,
+                                                  intids=intids,
+                                                  batch_size=4))
+        assert_that(items, has_length(3))
+        # The whole batch is prefetched before any state is loaded
+        assert_that(events[0], is_(('prefetch', 4)))
+        assert_that(events[1:], is_not(has_length(0)))
+
+    def _check_sorted(self, catalog):
+        # Most recent first
+        users = ('user1', 'user2')
+        rs, cursor = get_sorted_indexed_completed_items_intids(users=users,
+                                                               limit=3,
+                                                               catalog=catalog)
+        assert_that(rs, contains(1, 2, 3))
+        rs, cursor = get_sorted_indexed_completed_items_intids(users=users,
+                                                               limit=3,
+                                                               cursor=cursor,
+                                                               catalog=catalog)
+        assert_that(rs, contains(4))
+        assert_that(cursor, none())
+
+        # Oldest first
+        rs, cursor = get_sorted_indexed_completed_items_intids(users=users,
+                                                               limit=2,
+                                                               reverse=False,
+                                                               catalog=catalog)
+        assert_that(rs, contains(4, 3))
+        rs, cursor = get_sorted_indexed_completed_items_intids(users=users,
+                                                               limit=2,
+                                                               reverse=False,
+                                                               cursor=cursor,
+                                                               catalog=catalog)
+        assert_that(rs, contains(2, 1))
+
+        # Filtered, unlimited
+        rs, cursor = get_sorted_indexed_completed_items_intids(users='user2',
+                                                               catalog=catalog)
+        assert_that(rs, contains(3, 4))
+        assert_that(cursor, none())
+
+        rs, cursor = get_sorted_indexed_completed_items_intids(users='user3',
+                                                               catalog=catalog)
+        assert_that(rs, has_length(0))
+
+    def test_sorted_indexed_completed_items(self):
+        catalog = self._make_catalog()
+        self._check_sorted(catalog)
+        # Sorting small result sets in memory
+        patch = fudge.patch_object(utils, '_SORT_IN_MEMORY_RATIO', 0.1)
+        try:
+            self._check_sorted(catalog)
+        finally:
+            patch.restore()
+
+    def _check_query(self, catalog):
+        rs = get_indexed_completed_items_intids(users='user1',
+                                                items='completable1',
+                                                catalog=catalog)
+        assert_that(rs, contains(1))
+        rs = get_indexed_completed_items_intids(items='completable2',
+                                                success=True,
+                                                catalog=catalog)
+        assert_that(rs, contains(4))
+        rs = get_indexed_completed_items_intids(users=('user1', 'user2'),
+                                                success=False,
+                                                min_time=0,
+                                                catalog=catalog)
+        assert_that(rs, contains(2))
+        rs = get_indexed_completed_items_intids(users='user3',
+                                                success=True,
+                                                catalog=catalog)
+        assert_that(rs, has_length(0))
+        rs = get_indexed_completed_items_intids(users='user1',
+                                                sites='unknown',
+                                                catalog=catalog)
+        assert_that(rs, has_length(0))
+
+    def _check_success_counts(self, catalog):
+        items = ('completable1', 'completable2', 'completable3')
+        counts = count_indexed_completed_items_by_success(items, catalog=catalog)
+        assert_that(counts, is_({'completable1': (2, 0),
+                                 'completable2': (1, 1)}))
+        counts = count_indexed_completed_items_by_success(items,
+                                                          users='user1',
+                                                          catalog=catalog)
+        assert_that(counts, is_({'completable1': (1, 0),
+                                 'completable2': (0, 1)}))
+        counts = count_indexed_completed_items_by_success(items,
+                                                          users='user3',
+                                                          catalog=catalog)
+        assert_that(counts, is_({}))
+
+    def test_item_success_index(self):
+        catalog = self._make_catalog()
+        index = catalog[IX_ITEM_SUCCESS]
+        assert_that(index.documents_to_values,
+                    has_entries(1, ('completable1', True),
+                                2, ('completable2', False)))
+        self._check_success_counts(catalog)
+        # Catalogs without the composite index
+        del catalog[IX_ITEM_SUCCESS]
+        self._check_success_counts(catalog)
+        self._check_query(catalog)
+
+    def test_query_planner(self):
+        catalog = self._make_catalog()
+        self._check_query(catalog)
+        # Checking terms document by document gives the same results
+        patch = fudge.patch_object(utils, '_FILTER_RATIO', 0.1)
+        try:
+            self._check_query(catalog)
+        finally:
+            patch.restore()
+
     def test_install_completed_item_catalog(self):
         intids = fudge.Fake().provides('register').has_attr(family=BTrees.family64)
         catalog = install_completed_item_catalog(component, intids)
         assert_that(catalog, is_not(none()))
         component.getGlobalSiteManager().unregisterUtility(catalog, IDeferredCatalog,
                                                            COMPLETED_ITEM_CATALOG_NAME)
+
+    def test_context_principal_index(self):
+        def context_ntiid(item):
+            return _NTIID('context-%s' % item.Item.ntiid)
+        gsm = component.getGlobalSiteManager()
+        gsm.registerAdapter(context_ntiid, (ICompletedItem,), IContextNTIIDAdapter)
+        try:
+            catalog = self._make_catalog()
+        finally:
+            gsm.unregisterAdapter(context_ntiid, (ICompletedItem,), IContextNTIIDAdapter)
+        index = catalog[IX_CONTEXT_PRINCIPAL]
+        assert_that(index, has_property('documents_to_values', has_length(4)))
+
+        rs = get_indexed_completed_items_intids(users='user1',
+                                                contexts='context-completable2',
+                                                catalog=catalog)
+        assert_that(rs, contains(2))
+        rs = get_indexed_completed_items_intids(users=('user1', 'user2'),
+                                                contexts='context-completable1',
+                                                success=True,
+                                                catalog=catalog)
+        assert_that(rs, contains_inanyorder(1, 3))
+        rs = get_indexed_completed_items_intids(users='user3',
+                                                contexts='context-completable1',
+                                                catalog=catalog)
+        assert_that(rs, has_length(0))
+
+        # Large cross products use the single valued indexes
+        patch = fudge.patch_object(utils, '_MAX_CONTEXT_PRINCIPAL_KEYS', 1)
+        try:
+            rs = get_indexed_completed_items_intids(users=('user1', 'user2'),
+                                                    contexts='context-completable1',
+                                                    catalog=catalog)
+        finally:
+            patch.restore()
+        assert_that(rs, contains_inanyorder(1, 3))
+
+    def test_install_missing_indexes(self):
+        intids = fudge.Fake().provides('register').has_attr(family=BTrees.family64)
+        catalog = install_completed_item_catalog(component, intids)
+        gsm = component.getGlobalSiteManager()
+
+        def context_ntiid(unused_item):
+            return _NTIID('context')
+        gsm.registerAdapter(context_ntiid, (ICompletedItem,), IContextNTIIDAdapter)
+        try:
+            del catalog[IX_CONTEXT_PRINCIPAL]
+            context = MockCompletionContext()
+            context.ntiid = u'context'
+            user = MockUser(u'user1')
+            completed = CompletedItem(Principal=user,
+                                      Item=MockCompletableItem('completable1'),
+                                      CompletedDate=datetime.utcnow())
+            get_principal_completed_item_container(user, context).add_completed_item(completed)
+            catalog.force_index_doc(1, completed)
+
+            # Installing only adds the empty index, which queries ignore
+            install_completed_item_catalog(component, intids)
+            index = catalog[IX_CONTEXT_PRINCIPAL]
+            assert_that(index.documents_to_values, has_length(0))
+            assert_that(is_index_populated(catalog, IX_CONTEXT_PRINCIPAL),
+                        is_(False))
+            rs = get_indexed_completed_items_intids(users='user1',
+                                                    contexts='context',
+                                                    catalog=catalog)
+            assert_that(list(rs), is_([1]))
+
+            # Until populated in batches
+            predicate = fudge.Fake().provides('iter_objects').returns([context])
+            gsm.registerUtility(predicate, ICompletables, 'test')
+            try:
+                intids = fudge.Fake().provides('queryId').returns(1)
+                rebuild_completed_item_catalog(catalog, intids,
+                                               index_name=IX_CONTEXT_PRINCIPAL,
+                                               commit=False)
+            finally:
+                gsm.unregisterUtility(predicate, ICompletables, 'test')
+            assert_that(index.documents_to_values,
+                        has_entries(1, ('context', 'user1')))
+            assert_that(is_index_populated(catalog, IX_CONTEXT_PRINCIPAL),
+                        is_(True))
+        finally:
+            gsm.unregisterAdapter(context_ntiid, (ICompletedItem,),
+                                  IContextNTIIDAdapter)
+            gsm.unregisterUtility(catalog, IDeferredCatalog,
+                                  COMPLETED_ITEM_CATALOG_NAME)
+
+    def test_site_intids_cache(self):
+        def site_adapter(item):
+            site = 'alpha' if item.Principal.id == 'user1' else 'beta'
+            return fudge.Fake().has_attr(site=site)
+        gsm = component.getGlobalSiteManager()
+        gsm.registerAdapter(site_adapter, (ICompletedItem,), ISiteAdapter)
+        try:
+            catalog = self._make_catalog()
+        finally:
+            gsm.unregisterAdapter(site_adapter, (ICompletedItem,), ISiteAdapter)
+
+        for unused in range(2):
+            rs = get_indexed_completed_items_intids(sites='alpha',
+                                                    catalog=catalog)
+            assert_that(rs, contains(1, 2))
+        # Cached on the index itself
+        cache = catalog[IX_SITE]._v_site_intids[1]
+        assert_that(cache, has_length(1))
+        utils.invalidate_site_intids_cache(catalog)
+        assert_that(catalog[IX_SITE],
+                    is_not(has_property('_v_site_intids')))
+        rs = get_indexed_completed_items_intids(sites='alpha',
+                                                catalog=catalog)
+        assert_that(rs, contains(1, 2))
+
+        # Results are not the cached set
+        rs.remove(1)
+        rs = get_indexed_completed_items_intids(sites='alpha',
+                                                catalog=catalog)
+        assert_that(rs, contains(1, 2))
+
+        rs = get_indexed_completed_items_intids(sites=('alpha', 'beta'),
+                                                users='user2',
+                                                catalog=catalog)
+        assert_that(rs, contains(3, 4))
+        rs = get_indexed_completed_items_intids(sites='unknown',
+                                                catalog=catalog)
+        assert_that(rs, has_length(0))
+
+        # Changes to the site index are seen
+        catalog.unindex_doc(1)
+        rs = get_indexed_completed_items_intids(sites='alpha',
+                                                catalog=catalog)
+        assert_that(rs, contains(2))
+
+    def test_rebuild_completed_item_catalog(self):
+        now = datetime.utcnow()
+        docids = {}
+        completables = [MockCompletableItem('completable1')]
+        for ntiid in ('context3', 'context1', 'context2'):
+            context = MockCompletionContext()
+            context.ntiid = ntiid
+            for username in ('user1', 'user2'):
+                user = MockUser(username)
+                container = get_principal_completed_item_container(user, context)
+                item = CompletedItem(Principal=user,
+                                     Item=MockCompletableItem(ntiid),
+                                     CompletedDate=now)
+                container.add_completed_item(item)
+                docids[id(item)] = len(docids) + 1
+            completables.append(context)
+        # Without NTIID
+        completables.append(MockCompletionContext())
+
+        intids = fudge.Fake().provides('queryId').calls(lambda x: docids.get(id(x)))
+        predicate = fudge.Fake().provides('iter_objects').returns(completables)
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(predicate, ICompletables, 'test')
+        try:
+            catalog = create_completed_item_catalog()
+            # Stale documents are dropped
+            catalog[IX_PRINCIPAL].index_value(99, u'stale')
+            checkpoints = []
+            result = rebuild_completed_item_catalog(catalog, intids,
+                                                    batch_size=3,
+                                                    commit=False,
+                                                    checkpoint=lambda *x: checkpoints.append(x))
+            key = COMPLETED_ITEM_ANNOTATION_KEY
+            assert_that(result, has_entries('cursor', ('context3', key, 'user2'),
+                                            'contexts', 3,
+                                            'items', 6))
+            # Committed within contexts, in NTIID order
+            assert_that(checkpoints, contains((('context2', key, 'user1'), 3),
+                                              (('context3', key, 'user2'), 6),
+                                              (('context3', key, 'user2'), 6)))
+            assert_that(catalog[IX_PRINCIPAL].documents_to_values,
+                        has_length(6))
+
+            # Resume a single index within a context
+            catalog = create_completed_item_catalog()
+            result = rebuild_completed_item_catalog(catalog, intids,
+                                                    index_name=IX_ITEM_NTIID,
+                                                    cursor=('context2', key, 'user1'),
+                                                    commit=False)
+            assert_that(result, has_entries('contexts', 2, 'items', 3))
+            assert_that(dict(catalog[IX_ITEM_NTIID].documents_to_values),
+                        is_({6: 'context2', 1: 'context3', 2: 'context3'}))
+            assert_that(catalog[IX_PRINCIPAL].documents_to_values,
+                        has_length(0))
+        finally:
+            gsm.unregisterUtility(predicate, ICompletables, 'test')
+
+    def test_success_set_index(self):
+        catalog = self._make_catalog(success_index=SuccessSetIndex)
+        index = catalog[IX_SUCCESS]
+        assert_that(index, is_(SuccessSetIndex))
+        assert_that(index.documentCount(), is_(4))
+        assert_that(index.wordCount(), is_(2))
+        assert_that(list(index.apply({'any_of': (True,)})), is_([1, 3, 4]))
+        assert_that(list(index.apply({'any': None})), is_([1, 2, 3, 4]))
+        assert_that(index.documents_to_values.get(2), is_(False))
+
+        self._check_query(catalog)
+        del catalog[IX_ITEM_SUCCESS]
+        self._check_query(catalog)
+        counts = utils.count_indexed_completed_items_by_success(('completable1',),
+                                                                catalog=catalog)
+        assert_that(counts, is_({'completable1': (2, 0)}))
+
+        # Reindexing moves documents
+        completed = CompletedItem(Principal=MockUser(u'user1'),
+                                  Item=MockCompletableItem('completable1'),
+                                  CompletedDate=datetime.utcnow(),
+                                  Success=False)
+        index.index_doc(1, completed)
+        assert_that(index.documentCount(), is_(4))
+        assert_that(list(index.apply({'any_of': (False,)})), is_([1, 2]))
+        index.unindex_doc(1)
+        index.unindex_doc(1)
+        assert_that(index.documentCount(), is_(3))
+        index.clear()
+        assert_that(index.wordCount(), is_(0))
+
+    def test_single_pass_indexing(self):
+        def context_ntiid(item):
+            return _NTIID('context-%s' % item.Item.ntiid)
+        def site_adapter(unused_item):
+            return fudge.Fake().has_attr(site='alpha')
+        gsm = component.getGlobalSiteManager()
+        gsm.registerAdapter(context_ntiid, (ICompletedItem,), IContextNTIIDAdapter)
+        gsm.registerAdapter(site_adapter, (ICompletedItem,), ISiteAdapter)
+        try:
+            catalog = self._make_catalog()
+            # Index each document through every index separately
+            expected = create_completed_item_catalog(family=BTrees.family64)
+            for docid in range(1, 5):
+                completed = CompletedItem(Principal=MockUser(u'user%s' % docid),
+                                          Item=MockCompletableItem('completable'),
+                                          CompletedDate=datetime.utcnow(),
+                                          Success=bool(docid % 2))
+                catalog.index_doc(docid, completed)
+                for index in expected.values():
+                    index.index_doc(docid, completed)
+        finally:
+            gsm.unregisterAdapter(context_ntiid, (ICompletedItem,), IContextNTIIDAdapter)
+            gsm.unregisterAdapter(site_adapter, (ICompletedItem,), ISiteAdapter)
+
+        assert_that(catalog, has_length(len(expected)))
+        for index in catalog.values():
+            assert_that(index, has_property('index_value', not_none()))
+        for name, index in expected.items():
+            index = getattr(index, 'index', index)
+            actual = getattr(catalog[name], 'index', catalog[name])
+            assert_that(dict(actual.documents_to_values),
+                        is_(dict(index.documents_to_values)))
+            assert_that(actual.documents_to_values, has_length(4))
+
+    def test_single_pass_indexing_overrides(self):
+        catalog = create_completed_item_catalog(family=BTrees.family64)
+        completed = CompletedItem(Principal=MockUser(u'user1'),
+                                  Item=MockCompletableItem('completable1'),
+                                  CompletedDate=datetime.utcnow())
+        catalog.index_doc(1, completed)
+        assert_that(catalog[IX_ITEM_NTIID].documents_to_values.get(1),
+                    is_('completable1'))
+
+        # Adapters registered later are honored
+        def item_ntiid(unused_item):
+            return _NTIID('override')
+        gsm = component.getGlobalSiteManager()
+        gsm.registerAdapter(item_ntiid, (CompletedItem,), IItemNTIIDAdapter)
+        try:
+            catalog.index_doc(1, completed)
+        finally:
+            gsm.unregisterAdapter(item_ntiid, (CompletedItem,), IItemNTIIDAdapter)
+        assert_that(catalog[IX_ITEM_NTIID].documents_to_values.get(1),
+                    is_('override'))
+        catalog.index_doc(1, completed)
+        assert_that(catalog[IX_ITEM_NTIID].documents_to_values.get(1),
+                    is_('completable1'))
+
+    def test_completion_histogram(self):
+        now = datetime.utcnow()
+        catalog = self._make_catalog(now)
+        normalizer = TimestampNormalizer(TimestampNormalizer.RES_DAY)
+        # Docid n was completed n days ago
+        days = {docid: normalizer.value(now - timedelta(days=docid))
+                for docid in range(1, 5)}
+        histogram = get_indexed_completion_histogram(catalog=catalog)
+        assert_that(histogram, is_({day: 1 for day in days.values()}))
+
+        histogram = get_indexed_completion_histogram(users='user1',
+                                                     catalog=catalog)
+        assert_that(histogram, is_({days[1]: 1, days[2]: 1}))
+        histogram = get_indexed_completion_histogram(items='completable1',
+                                                     success=True,
+                                                     catalog=catalog)
+        assert_that(histogram, is_({days[1]: 1, days[3]: 1}))
+        histogram = get_indexed_completion_histogram(success=False,
+                                                     catalog=catalog)
+        assert_that(histogram, is_({days[2]: 1}))
+        histogram = get_indexed_completion_histogram(users='user3',
+                                                     catalog=catalog)
+        assert_that(histogram, is_({}))
+
+    def test_indexing_subscribers(self):
+        item = CompletedItem(Principal=MockUser(u'user1'),
+                             Item=MockCompletableItem('completable1'),
+                             CompletedDate=datetime.utcnow())
+        intids = fudge.Fake().provides('register').has_attr(family=BTrees.family64)
+        intids.provides('queryId').returns(1)
+        catalog = install_completed_item_catalog(component, intids)
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        try:
+            transaction.begin()
+            _queue_completed_item_added(item)
+            assert_that(catalog[IX_PRINCIPAL].documents_to_values, has_length(0))
+            transaction.commit()
+            assert_that(catalog[IX_PRINCIPAL].documents_to_values,
+                        has_entries(1, 'user1'))
+
+            transaction.begin()
+            _queue_completed_item_removed(item)
+            transaction.commit()
+            assert_that(catalog[IX_PRINCIPAL].documents_to_values, has_length(0))
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+            gsm.unregisterUtility(catalog, IDeferredCatalog,
+                                  COMPLETED_ITEM_CATALOG_NAME)
+
+    def test_indexing_queue(self):
+        calls = []
+        catalog = fudge.Fake('catalog')
+        catalog.provides('index_doc').calls(lambda *x: calls.append(('index',) + x))
+        catalog.provides('unindex_doc').calls(lambda x: calls.append(('unindex', x)))
+
+        transaction.begin()
+        queue = get_completed_item_indexing_queue(catalog)
+        assert_that(get_completed_item_indexing_queue(catalog), is_(queue))
+        queue.index_doc(5, 'five')
+        queue.unindex_doc(5)
+        queue.unindex_doc(3)
+        queue.index_doc(3, 'three')
+        queue.index_doc(1, 'one')
+        assert_that(queue, has_length(3))
+        assert_that(calls, has_length(0))
+        transaction.commit()
+        # Coalesced and applied in docid order on commit
+        assert_that(calls, contains(('index', 1, 'one'),
+                                    ('index', 3, 'three'),
+                                    ('unindex', 5)))
+
+        # Replacing the completed item of a (principal, item) key
+        del calls[:]
+        transaction.begin()
+        queue = get_completed_item_indexing_queue(catalog)
+        items = [CompletedItem(Principal=MockUser(u'user1'),
+                               Item=MockCompletableItem('completable1'),
+                               CompletedDate=datetime.utcnow())
+                 for unused in range(3)]
+        queue.unindex_doc(10, items[0])
+        queue.index_doc(11, items[1], added=True)
+        queue.unindex_doc(11, items[1])
+        queue.index_doc(12, items[2], added=True)
+        assert_that(queue, has_length(2))
+        transaction.commit()
+        assert_that(calls, contains(('unindex', 10),
+                                    ('index', 12, items[2])))
+
+        # Aborted operations are dropped
+        del calls[:]
+        transaction.begin()
+        get_completed_item_indexing_queue(catalog).index_doc(1, 'one')
+        transaction.abort()
+        assert_that(calls, has_length(0))
+        assert_that(get_completed_item_indexing_queue(catalog, create=False),
+                    none())
+
+        # No catalog, no queue
+        assert_that(get_completed_item_indexing_queue(), none())
+
+        # Queries see the queued operations
+        catalog = self._make_catalog()
+        queue = get_completed_item_indexing_queue(catalog)
+        queue.unindex_doc(1)
+        rs = get_indexed_completed_items_intids(users='user1', catalog=catalog)
+        assert_that(rs, contains(2))
+        assert_that(queue, has_length(0))
+        transaction.abort()
@@ -11,6 +11,10 @@ from unittest import TestCase
 
 import fudge
 
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import not_none
+from hamcrest import contains
 from hamcrest import assert_that
 from hamcrest import has_length
 from hamcrest import has_properties
@@ -21,20 +25,31 @@ from zope import interface
 
 from ZODB.interfaces import IConnection
 
+from zope.annotation.interfaces import IAnnotations
+
 from zope.component import eventtesting
+
+from zope.event import notify
 from zope.lifecycleevent import IObjectAddedEvent
 
 from zope.lifecycleevent import IObjectRemovedEvent
 
 from zope.security.interfaces import IPrincipal
 
+from nti.contenttypes.completion.adapters import COMPLETABLE_ITEM_ANNOTATION_KEY
+from nti.contenttypes.completion.adapters import COMPLETABLE_ITEM_DEFAULT_REQUIRED_ANNOTATION_KEY
+
 from nti.contenttypes.completion.interfaces import ICompletableItemCompletionPolicy
+from nti.contenttypes.completion.interfaces import ICompletableItemProvider
 from nti.contenttypes.completion.interfaces import ICompletableItemContainer
+from nti.contenttypes.completion.interfaces import ICompletableItemDefaultRequiredPolicy
 from nti.contenttypes.completion.interfaces import ICompletedItem
 from nti.contenttypes.completion.interfaces import ICompletionContext
 from nti.contenttypes.completion.interfaces import IPrincipalCompletedItemContainer
 from nti.contenttypes.completion.interfaces import IProgress
+from nti.contenttypes.completion.interfaces import IRequiredCompletableItemProvider
 from nti.contenttypes.completion.interfaces import IUserProgressUpdatedEvent
+from nti.contenttypes.completion.interfaces import CompletionContextCompletionPolicyUpdated
 
 from nti.contenttypes.completion.policies import AbstractCompletableItemCompletionPolicy
 
@@ -42,10 +57,20 @@ from nti.contenttypes.completion.tests import DSSharedConfiguringTestLayer
 
 from nti.contenttypes.completion.tests.interfaces import ITestCompletableItem
 
+from nti.contenttypes.completion.tests.test_models import MockUser
 from nti.contenttypes.completion.tests.test_models import MockCompletableItem
 from nti.contenttypes.completion.tests.test_models import MockCompletionContext
 
+from nti.contenttypes.completion.utils import is_item_required
+from nti.contenttypes.completion.utils import get_completable_items_for_user
+from nti.contenttypes.completion.utils import invalidate_completable_items_cache
+from nti.contenttypes.completion.utils import iter_completable_items_for_user
+from nti.contenttypes.completion.utils import get_required_completable_items_for_user
+from nti.contenttypes.completion.utils import iter_required_completable_items_for_user
+from nti.contenttypes.completion.utils import get_required_item_ntiids
 from nti.contenttypes.completion.utils import update_completion
+from nti.contenttypes.completion.utils import update_completion_many
+from nti.contenttypes.completion.utils import update_completion_for_items
 
 from nti.coremetadata.interfaces import IDataserver
 
@@ -54,6 +79,176 @@ from nti.dataserver.tests.mock_dataserver import WithMockDSTrans
 from nti.dataserver.users import User
 
 
+class TestIsItemRequired(TestCase):
+
+    layer = DSSharedConfiguringTestLayer
+
+    def test_is_item_required(self):
+        obj = MockCompletableItem("test_ntiid")
+        obj.mime_type = 'application/vnd.nextthought.test'
+        context = MockCompletionContext()
+        assert_that(is_item_required(object(), context), is_(False))
+        assert_that(is_item_required(obj, context), is_(False))
+
+        # Changes are seen by subsequent checks
+        default_policy = ICompletableItemDefaultRequiredPolicy(context)
+        default_policy.add_mime_types((obj.mime_type,))
+        assert_that(is_item_required(obj, context), is_(True))
+
+        completable_container = ICompletableItemContainer(context)
+        completable_container.add_optional_item(obj)
+        assert_that(is_item_required(obj, context), is_(False))
+
+        completable_container.remove_optional_item(obj)
+        assert_that(is_item_required(obj, context), is_(True))
+
+        default_policy.set_mime_types(())
+        assert_that(is_item_required(obj, context), is_(False))
+
+        completable_container.add_required_item(obj)
+        assert_that(is_item_required(obj, context), is_(True))
+
+        completable_container.clear()
+        assert_that(is_item_required(obj, context), is_(False))
+
+    def test_get_required_item_ntiids(self):
+        mime_type = 'application/vnd.nextthought.test'
+        obj1 = MockCompletableItem("test_ntiid1")
+        obj2 = MockCompletableItem("test_ntiid2")
+        obj3 = MockCompletableItem("test_ntiid3")
+        obj2.mime_type = obj3.mime_type = mime_type
+        context = MockCompletionContext()
+        completable_container = ICompletableItemContainer(context)
+        default_policy = ICompletableItemDefaultRequiredPolicy(context)
+        items = (obj1, obj2, obj3)
+        assert_that(get_required_item_ntiids(context, items), has_length(0))
+
+        completable_container.add_required_item(obj1)
+        assert_that(get_required_item_ntiids(context, items),
+                    is_(frozenset(("test_ntiid1",))))
+
+        default_policy.add_mime_types((mime_type,))
+        assert_that(get_required_item_ntiids(context, items),
+                    is_(frozenset(("test_ntiid1", "test_ntiid2", "test_ntiid3"))))
+        # Only the given items are considered
+        assert_that(get_required_item_ntiids(context, (obj2, object())),
+                    is_(frozenset(("test_ntiid2",))))
+
+        completable_container.add_optional_item(obj3)
+        assert_that(get_required_item_ntiids(context, (obj1, obj2, obj3)),
+                    is_(frozenset(("test_ntiid1", "test_ntiid2"))))
+
+        default_policy.set_mime_types(())
+        assert_that(get_required_item_ntiids(context, (obj1, obj2, obj3)),
+                    is_(frozenset(("test_ntiid1",))))
+
+
+class TestCompletableItems(TestCase):
+
+    layer = DSSharedConfiguringTestLayer
+
+    def test_completable_items_for_user(self):
+        obj1 = MockCompletableItem("test_ntiid1")
+        obj2 = MockCompletableItem("test_ntiid2")
+        obj3 = MockCompletableItem("test_ntiid3")
+        context = MockCompletionContext()
+
+        def _provider(items):
+            @component.adapter(ICompletionContext)
+            class _Provider(object):
+
+                def __init__(self, *args):
+                    pass
+
+                def iter_items(self, unused_user):
+                    for item in items:
+                        yield item
+            return _Provider
+
+        first = _provider((obj1, obj2))
+        second = _provider((obj2, obj3))
+        with _registered_subscriber(first, provided=ICompletableItemProvider), \
+                _registered_subscriber(second, provided=ICompletableItemProvider), \
+                _registered_subscriber(first, provided=IRequiredCompletableItemProvider):
+            # Streaming yields each item once, in provider order
+            timings = {}
+            items = list(iter_completable_items_for_user(None, context, timings))
+            assert_that(items, contains(obj1, obj2, obj3))
+            assert_that(timings, has_length(2))
+
+            items = list(iter_required_completable_items_for_user(None, context))
+            assert_that(items, contains(obj1, obj2))
+
+            assert_that(get_completable_items_for_user(None, context),
+                        is_({obj1, obj2, obj3}))
+            assert_that(get_required_completable_items_for_user(None, context),
+                        is_({obj1, obj2}))
+
+            timings = {}
+            items = get_completable_items_for_user(None, context, timings=timings)
+            assert_that(items, is_({obj1, obj2, obj3}))
+            assert_that(timings, has_length(2))
+
+    def test_completable_items_cache(self):
+        obj1 = MockCompletableItem("test_ntiid1")
+        obj2 = MockCompletableItem("test_ntiid2")
+        user = MockUser(u'user1')
+        context = MockCompletionContext()
+        context.ntiid = u'tag:nextthought.com,2011-10:NTI-TEST-context'
+        items = [obj1]
+
+        @component.adapter(ICompletionContext)
+        class _Provider(object):
+
+            def __init__(self, *args):
+                pass
+
+            def iter_items(self, unused_user):
+                return list(items)
+
+        with _registered_subscriber(_Provider, provided=ICompletableItemProvider):
+            assert_that(get_completable_items_for_user(user, context, use_cache=True),
+                        is_({obj1}))
+            # Computing the cache key does not create the required state
+            annotations = IAnnotations(context)
+            assert_that(annotations.get(COMPLETABLE_ITEM_ANNOTATION_KEY), none())
+            assert_that(annotations.get(COMPLETABLE_ITEM_DEFAULT_REQUIRED_ANNOTATION_KEY),
+                        none())
+            items.append(obj2)
+            # Cached (and uncached lookups see the change)
+            assert_that(get_completable_items_for_user(user, context, use_cache=True),
+                        is_({obj1}))
+            assert_that(get_completable_items_for_user(user, context),
+                        is_({obj1, obj2}))
+
+            # Explicit invalidation
+            invalidate_completable_items_cache(context, user=u'user2')
+            assert_that(get_completable_items_for_user(user, context, use_cache=True),
+                        is_({obj1}))
+            invalidate_completable_items_cache(context, user=user)
+            assert_that(get_completable_items_for_user(user, context, use_cache=True),
+                        is_({obj1, obj2}))
+
+            # Required state changes
+            items.remove(obj1)
+            ICompletableItemContainer(context).add_required_item(obj2)
+            assert_that(get_completable_items_for_user(user, context, use_cache=True),
+                        is_({obj2}))
+
+            # Policy updates
+            items.append(obj1)
+            notify(CompletionContextCompletionPolicyUpdated(context))
+            assert_that(get_completable_items_for_user(user, context, use_cache=True),
+                        is_({obj1, obj2}))
+
+            # Cached on the context; global invalidation outdates it
+            assert_that(context._v_completable_items_cache, not_none())
+            items.remove(obj1)
+            invalidate_completable_items_cache()
+            assert_that(get_completable_items_for_user(user, context, use_cache=True),
+                        is_({obj2}))
+
+
 class TestUpdateCompletion(TestCase):
 
     layer = DSSharedConfiguringTestLayer
@@ -328,6 +523,105 @@ class TestUpdateCompletion(TestCase):
         self._verify_events(completed_item,
                             removed=True, progress_updated=True)
 
+    @fudge.patch('nti.contenttypes.completion.utils.logger')
+    @WithMockDSTrans
+    def test_update_completion_many(self, _logger):
+        obj = MockCompletableItem("test_ntiid")
+        prin1 = IPrincipal(User.create_user(username='completion_tester1'))
+        prin2 = IPrincipal(User.create_user(username='completion_tester2'))
+        completed_item = self._fake_completed_item(obj.ntiid, prin1, success=True)
+        new_completed_item = self._fake_completed_item(obj.ntiid, prin2, success=True)
+
+        context = MockCompletionContext()
+        IConnection(component.getUtility(IDataserver).dataserver_folder).add(context)
+        ICompletableItemContainer(context).add_required_item(obj)
+        container1 = component.queryMultiAdapter((prin1, context),
+                                                 IPrincipalCompletedItemContainer)
+        container1.add_completed_item(completed_item)
+        container2 = component.queryMultiAdapter((prin2, context),
+                                                 IPrincipalCompletedItemContainer)
+        eventtesting.clearEvents()
+
+        progress_adapter = fudge.Fake('ProgressAdapter').is_callable().returns(object())
+        item_completion_policy = self._completion_policy(new_completed_item)
+        with _registered_adapter(progress_adapter,
+                                 required=(IPrincipal, ITestCompletableItem, ICompletionContext),
+                                 provided=IProgress):
+            with _registered_adapter(item_completion_policy,
+                                     provided=ICompletableItemCompletionPolicy):
+                changed = update_completion_many(obj, obj.ntiid,
+                                                 (prin1, prin2, None),
+                                                 object())
+                assert_that(changed, has_length(0))
+
+                changed = update_completion_many(obj, obj.ntiid,
+                                                 (prin1, prin2), context)
+
+        # Only the user without a successful completion changed
+        assert_that(changed, contains(prin2))
+        assert_that(container1[obj.ntiid], is_(completed_item))
+        assert_that(container2[obj.ntiid], is_(new_completed_item))
+
+        events = eventtesting.getEvents(event_type=IUserProgressUpdatedEvent)
+        assert_that(events, has_length(1))
+        assert_that(events[0].user, is_(prin2))
+
+    @fudge.patch('nti.contenttypes.completion.utils.logger')
+    @WithMockDSTrans
+    def test_update_completion_for_items(self, _logger):
+        prin = IPrincipal(User.create_user(username='completion_tester'))
+        objs = [MockCompletableItem("test_ntiid%s" % idx) for idx in range(3)]
+        completed_items = {
+            obj.ntiid: self._fake_completed_item(obj.ntiid, prin, success=True)
+            for obj in objs
+        }
+
+        context = MockCompletionContext()
+        IConnection(component.getUtility(IDataserver).dataserver_folder).add(context)
+        ICompletableItemContainer(context).add_required_item(objs[0])
+        ICompletableItemContainer(context).add_required_item(objs[1])
+        ICompletableItemContainer(context).add_optional_item(objs[2])
+        container = component.queryMultiAdapter((prin, context),
+                                                IPrincipalCompletedItemContainer)
+        eventtesting.clearEvents()
+
+        # Our progress is the item ntiid, which the policy maps to its
+        # completed item.
+        @component.adapter(ITestCompletableItem, ICompletionContext)
+        class MockCompletionPolicy(AbstractCompletableItemCompletionPolicy):
+
+            def __init__(self, *args, **kwargs):
+                pass
+
+            def is_complete(self, progress):
+                return completed_items[progress]
+
+        def progress_adapter(unused_user, obj, unused_context):
+            return obj.ntiid
+
+        with _registered_adapter(progress_adapter,
+                                 required=(IPrincipal, ITestCompletableItem, ICompletionContext),
+                                 provided=IProgress):
+            with _registered_adapter(MockCompletionPolicy,
+                                     provided=ICompletableItemCompletionPolicy):
+                changed = update_completion_for_items(objs, prin, object())
+                assert_that(changed, has_length(0))
+
+                changed = update_completion_for_items(objs, prin, context)
+                assert_that(changed, contains(*objs))
+                assert_that(container, has_length(3))
+
+                # Only one progress event for the context
+                events = eventtesting.getEvents(event_type=IUserProgressUpdatedEvent)
+                assert_that(events, has_length(1))
+
+                # Already complete items are skipped
+                eventtesting.clearEvents()
+                changed = update_completion_for_items(objs, prin, context)
+                assert_that(changed, has_length(0))
+                events = eventtesting.getEvents(event_type=IUserProgressUpdatedEvent)
+                assert_that(events, has_length(0))
+
     def _verify_logging_counts(self, messages, info=0, debug=0, warning=0):
         assert_that(messages['info'], has_length(info))
         assert_that(messages['debug'], has_length(debug))
@@ -440,3 +734,13 @@ def _registered_adapter(adapter, **kwargs):
         yield
     finally:
         gsm.unregisterAdapter(adapter, **kwargs)
+
+
+@contextmanager
+def _registered_subscriber(subscriber, **kwargs):
+    gsm = component.getGlobalSiteManager()
+    gsm.registerSubscriptionAdapter(subscriber, **kwargs)
+    try:
+        yield
+    finally:
+        gsm.unregisterSubscriptionAdapter(subscriber, **kwargs)
@@ -8,8 +8,21 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import sys
+import time
+import heapq
+import weakref
+import itertools
+import threading
+
+from collections import OrderedDict
+
 import six
 
+import BTrees
+
+import transaction
+
 from zope import component
 
 from zope.component.hooks import getSite
@@ -18,6 +31,12 @@ from zope.event import notify
 
 from zope.intid.interfaces import IIntIds
 
+from nti.contenttypes.completion.adapters import COMPLETABLE_ITEM_ANNOTATION_KEY
+from nti.contenttypes.completion.adapters import READ_ONLY_PRINCIPAL_CONTAINER_NAME
+from nti.contenttypes.completion.adapters import COMPLETABLE_ITEM_DEFAULT_REQUIRED_ANNOTATION_KEY
+
+from nti.contenttypes.completion.adapters import _query_annotation
+
 from nti.contenttypes.completion.index import IX_SITE
 from nti.contenttypes.completion.index import IX_SUCCESS
 from nti.contenttypes.completion.index import IX_PRINCIPAL
@@ -25,8 +44,12 @@ from nti.contenttypes.completion.index import IX_ITEM_NTIID
 from nti.contenttypes.completion.index import IX_CONTEXT_NTIID
 from nti.contenttypes.completion.index import IX_COMPLETIONTIME
 from nti.contenttypes.completion.index import IX_COMPLETION_BY_DAY
+from nti.contenttypes.completion.index import IX_ITEM_SUCCESS
+from nti.contenttypes.completion.index import IX_CONTEXT_PRINCIPAL
 
+from nti.contenttypes.completion.index import is_index_populated
 from nti.contenttypes.completion.index import get_completed_item_catalog
+from nti.contenttypes.completion.index import flush_completed_item_indexing_queue
 
 from nti.contenttypes.completion.interfaces import IProgress
 from nti.contenttypes.completion.interfaces import ICompletedItem
@@ -42,20 +65,34 @@ from nti.contenttypes.completion.interfaces import ICompletableItemDefaultRequir
 
 from nti.site.site import get_component_hierarchy_names
 
+from nti.zope_catalog.number import bit64_int_to_number
+
 logger = __import__('logging').getLogger(__name__)
 
 
-def is_item_required(item, context):
+#: Transaction -> {id(context): (context, required container, default policy)}
+_required_state_cache = weakref.WeakKeyDictionary()
+
+
+def _get_required_state(context):
     """
-    Returns a bool if the given item is `required` in this
-    :class:`ICompletionContext`.
-    :param item: the :class:`ICompletableItem`
-    :param context: the :class:`ICompletionContext`
+    Return the :class:`ICompletableItemContainer` and
+    :class:`ICompletableItemDefaultRequiredPolicy` for the context, adapting
+    them only once per transaction.
     """
-    if not ICompletableItem.providedBy(item):
-        return False
-    required_container = ICompletableItemContainer(context)
-    default_policy = ICompletableItemDefaultRequiredPolicy(context)
+    current = transaction.get()
+    cache = _required_state_cache.get(current)
+    if cache is None:
+        cache = _required_state_cache[current] = {}
+    state = cache.get(id(context))
+    if state is None or state[0] is not context:
+        state = cache[id(context)] = (context,
+                                      ICompletableItemContainer(context),
+                                      ICompletableItemDefaultRequiredPolicy(context))
+    return state[1:]
+
+
+def _is_item_required(item, required_container, default_policy):
     # pylint: disable=too-many-function-args
     if required_container.is_item_required(item):
         result = True
@@ -63,11 +100,130 @@ def is_item_required(item, context):
         result = False
     else:
         item_mime_type = getattr(item, 'mime_type', '')
+        get_mime_types = getattr(default_policy, 'get_mime_type_set', None)
+        if get_mime_types is not None:
+            mime_types = get_mime_types()
+        else:
+            mime_types = default_policy.mime_types
         # pylint: disable=unsupported-membership-test
-        result = item_mime_type in default_policy.mime_types
+        result = item_mime_type in mime_types
     return result
 
 
+def is_item_required(item, context):
+    """
+    Returns a bool if the given item is `required` in this
+    :class:`ICompletionContext`.
+    :param item: the :class:`ICompletableItem`
+    :param context: the :class:`ICompletionContext`
+    """
+    if not ICompletableItem.providedBy(item):
+        return False
+    required_container, default_policy = _get_required_state(context)
+    return _is_item_required(item, required_container, default_policy)
+
+
+def _version_stamp(obj):
+    """
+    Return a stamp that changes whenever the required state held by the given
+    object changes, or None if it cannot be determined. A missing object
+    is version 0.
+    """
+    if obj is None:
+        return (0, None)
+    changes = getattr(obj, '_changes', None)
+    # Objects changed in the current transaction are always re-read, since
+    # their change count may be rolled back.
+    if getattr(obj, '_p_changed', False) or getattr(changes, '_p_changed', False):
+        return None
+    if changes is None:
+        # Never changed since created
+        return (0, getattr(obj, '_p_serial', None))
+    return (changes(), getattr(changes, '_p_serial', None))
+
+
+def get_required_item_ntiids(context, items):
+    """
+    Return a frozenset of the NTIIDs of the required items among the given
+    items of the :class:`ICompletionContext`.
+
+    :param context: the :class:`ICompletionContext`
+    :param items: an iterable of candidate :class:`ICompletableItem` objects,
+        e.g. those returned by :func:`get_completable_items_for_user`.
+    """
+    required_container, default_policy = _get_required_state(context)
+    return frozenset(x.ntiid for x in items
+                     if      ICompletableItem.providedBy(x)
+                         and _is_item_required(x, required_container, default_policy))
+
+
+def _policy_resolver(obj, context):
+    """
+    Return a callable that lazily resolves (once) the
+    :class:`ICompletableItemCompletionPolicy` for the given item and context.
+    """
+    policies = []
+
+    def get_policy():
+        if not policies:
+            policy = component.getMultiAdapter((obj, context),
+                                               ICompletableItemCompletionPolicy)
+            policies.append(policy)
+        return policies[0]
+    return get_policy
+
+
+def _update_principal_completion(obj, ntiid, user, context,
+                                 principal_container, get_policy,
+                                 overwrite=False):
+    """
+    Update the completed state of the item in the given principal container,
+    returning a bool indicating whether the user's completion state (complete
+    or success) changed.
+    """
+    # Update completion if the user has no completion or
+    # if they have not completed the item successfully.
+    if          ntiid in principal_container \
+            and principal_container[ntiid].Success \
+            and not overwrite:
+        return False
+
+    policy = get_policy()
+    progress = component.queryMultiAdapter((user, obj, context),
+                                           IProgress)
+    # Pop the old value
+    prev_success = was_complete = False
+    if ntiid in principal_container:
+        prev_success = principal_container[ntiid].Success
+        was_complete = principal_container.remove_item(obj)
+
+    success = False
+    completed_item = None
+    if progress is not None:
+        completed_item = policy.is_complete(progress)
+        if completed_item is not None:
+            # The completed item we get may be different from the given
+            # obj.
+            logger.info('Marking item complete (ntiid=%s) (user=%s) (item=%s)',
+                        ntiid, user.username, completed_item)
+            assert ICompletedItem.providedBy(completed_item), \
+                   "Must have completed item"
+            principal_container[ntiid] = completed_item
+            success = completed_item.Success
+        else:
+            logger.debug('Item is not complete (ntiid=%s) (user=%s) (item=%s) (progress=%s)',
+                         ntiid, user.username, completed_item, progress)
+
+    is_complete = completed_item is not None
+    if was_complete and not is_complete:
+        logger.info('Removed progress for user (%s) (item=%s)',
+                    user, ntiid)
+    # We broadcast for the context if we have a successfully completed
+    # item where we did not before, or if it was previously successful
+    # and no longer is
+    return prev_success != success or was_complete != is_complete
+
+
 def update_completion(obj, ntiid, user, context, overwrite=False):
     """
     For the given object and user, update the completed state for the
@@ -87,51 +243,99 @@ def update_completion(obj, ntiid, user, context, overwrite=False):
         logger.warning('No container found for progress update (%s) (%s)',
                        ntiid, context)
         return
-    # Update completion if the user has no completion or
-    # if they have not completed the item successfully.
-    if          ntiid not in principal_container \
-            or not principal_container[ntiid].Success \
-            or overwrite:
-        policy = component.getMultiAdapter((obj, context),
-                                           ICompletableItemCompletionPolicy)
-        progress = component.queryMultiAdapter((user, obj, context),
-                                               IProgress)
-        # Pop the old value
-        prev_success = was_complete = False
-        if ntiid in principal_container:
-            prev_success = principal_container[ntiid].Success
-            was_complete = principal_container.remove_item(obj)
-
-        success = False
-        completed_item = None
-        if progress is not None:
-            completed_item = policy.is_complete(progress)
-            if completed_item is not None:
-                # The completed item we get may be different from the given
-                # obj.
-                logger.info('Marking item complete (ntiid=%s) (user=%s) (item=%s)',
-                            ntiid, user.username, completed_item)
-                assert ICompletedItem.providedBy(completed_item), \
-                       "Must have completed item"
-                principal_container[ntiid] = completed_item
-                success = completed_item.Success
-            else:
-                logger.debug('Item is not complete (ntiid=%s) (user=%s) (item=%s) (progress=%s)',
-                             ntiid, user.username, completed_item, progress)
-
-        is_complete = completed_item is not None
-        if was_complete and not is_complete:
-            logger.info('Removed progress for user (%s) (item=%s)',
-                        user, ntiid)
-
-        if is_item_required(obj, context) \
-                and (prev_success != success or was_complete != is_complete):
-            # We broadcast for the context if we have a successfully completed
-            # item where we did not before, or if it was previously successful
-            # and no longer is
+    changed = _update_principal_completion(obj, ntiid, user, context,
+                                           principal_container,
+                                           _policy_resolver(obj, context),
+                                           overwrite=overwrite)
+    if changed and is_item_required(obj, context):
+        notify(UserProgressUpdatedEvent(obj=context,
+                                        user=user,
+                                        context=context))
+
+
+def update_completion_many(obj, ntiid, users, context, overwrite=False):
+    """
+    For the given object, update the completed state of each of the given
+    users for the completion context based on their adapted
+    :class:`IProgress`, if necessary. The item completion policy and whether
+    the item is required are resolved only once.
+
+    :param obj: the :class:`ICompletableItem`
+    :param ntiid: the ntiid of the completable item
+    :param users: an iterable of users who have updated progress on the item
+    :param context: the :class:`ICompletionContext`
+    :param overwrite: Whether to overwrite existing completion status
+    :return: the list of users whose completion state changed
+    """
+    result = []
+    required = None
+    get_policy = _policy_resolver(obj, context)
+    for user in users:
+        principal_container = component.queryMultiAdapter((user, context),
+                                                          IPrincipalCompletedItemContainer)
+        if principal_container is None:
+            logger.warning('No container found for progress update (%s) (%s) (%s)',
+                           ntiid, user, context)
+            continue
+        changed = _update_principal_completion(obj, ntiid, user, context,
+                                               principal_container,
+                                               get_policy,
+                                               overwrite=overwrite)
+        if not changed:
+            continue
+        result.append(user)
+        if required is None:
+            required = is_item_required(obj, context)
+        if required:
             notify(UserProgressUpdatedEvent(obj=context,
                                             user=user,
                                             context=context))
+    return result
+
+
+def update_completion_for_items(items, user, context, overwrite=False):
+    """
+    For the given user, update the completed state of each of the given
+    objects for the completion context based on the adapted
+    :class:`IProgress`, if necessary. The principal container and the
+    context's required state are resolved only once, and a single
+    :class:`IUserProgressUpdatedEvent` is broadcast if any required item
+    changed.
+
+    :param items: an iterable of :class:`ICompletableItem` objects
+    :param user: the user who has updated progress on the items
+    :param context: the :class:`ICompletionContext`
+    :param overwrite: Whether to overwrite existing completion status
+    :return: the list of items whose completion state changed
+    """
+    result = []
+    principal_container = component.queryMultiAdapter((user, context),
+                                                      IPrincipalCompletedItemContainer)
+    if principal_container is None:
+        logger.warning('No container found for progress update (%s) (%s)',
+                       user, context)
+        return result
+    required_container = default_policy = None
+    required_changed = False
+    for obj in items:
+        changed = _update_principal_completion(obj, obj.ntiid, user, context,
+                                               principal_container,
+                                               _policy_resolver(obj, context),
+                                               overwrite=overwrite)
+        if not changed:
+            continue
+        result.append(obj)
+        if required_changed or not ICompletableItem.providedBy(obj):
+            continue
+        if required_container is None:
+            required_container, default_policy = _get_required_state(context)
+        required_changed = _is_item_required(obj, required_container,
+                                             default_policy)
+    if required_changed:
+        notify(UserProgressUpdatedEvent(obj=context,
+                                        user=user,
+                                        context=context))
+    return result
 
 
 def remove_completion(obj, ntiid, user, context):
@@ -162,6 +366,19 @@ def remove_completion(obj, ntiid, user, context):
                                             context=context))
 
 
+def _query_principal_container(user, context, provided):
+    """
+    Return the principal container of the given interface through the
+    registered read-only adapter, which does not store a missing container,
+    falling back to the default adapter.
+    """
+    result = component.queryMultiAdapter((user, context), provided,
+                                         name=READ_ONLY_PRINCIPAL_CONTAINER_NAME)
+    if result is None:
+        result = component.getMultiAdapter((user, context), provided)
+    return result
+
+
 def get_completed_item(user, context, item):
     """
     Return the :class:`ICompletedItem` for the given context, user and item.
@@ -169,8 +386,8 @@ def get_completed_item(user, context, item):
     :param context: the :class:`ICompletionContext`
     :param obj: the :class:`ICompletableItem`
     """
-    user_container = component.getMultiAdapter((user, context),
-                                               IPrincipalCompletedItemContainer)
+    user_container = _query_principal_container(user, context,
+                                                IPrincipalCompletedItemContainer)
     return user_container.get_completed_item(item)
 
 
@@ -181,39 +398,211 @@ def get_awarded_completed_item(user, context, item):
     :param context: the :class:`ICompletionContext`
     :param obj: the :class:`ICompletableItem`
     """
-    user_container = component.getMultiAdapter((user, context),
-                                               IPrincipalAwardedCompletedItemContainer)
+    user_container = _query_principal_container(user, context,
+                                                IPrincipalAwardedCompletedItemContainer)
     return user_container.get_completed_item(item)
 
 
-def get_completable_items_for_user(user, context):
+def _timed_provider_items(item_provider, user, timings=None):
+    """
+    Iterate the items of the provider, recording the time spent in the
+    provider (but not in our consumer) in `timings`, if given.
+    """
+    elapsed = 0
+    start = time.time()
+    completable_items = iter(item_provider.iter_items(user))
+    elapsed += time.time() - start
+    while True:
+        start = time.time()
+        try:
+            item = next(completable_items)
+        except StopIteration:
+            break
+        finally:
+            elapsed += time.time() - start
+        yield item
+    if timings is not None:
+        timings[item_provider] = elapsed
+
+
+def _iter_provided_items(provider_iface, user, context, timings=None):
+    seen = set()
+    item_providers = component.subscribers((context,), provider_iface)
+    for item_provider in item_providers:
+        for item in _timed_provider_items(item_provider, user, timings):
+            if item not in seen:
+                seen.add(item)
+                yield item
+
+
+class _LRUCache(object):
+    """
+    A small, thread-safe, bounded least-recently-used mapping.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, predicate=None):
+        with self._lock:
+            if predicate is None:
+                self._data.clear()
+                return
+            for key in [x for x in self._data if predicate(x)]:
+                del self._data[key]
+
+
+#: Bumped to invalidate every cached set of completable items
+_completable_items_generation = 0
+
+
+def _completable_items_cache(context, create=False):
+    """
+    Return the cache of provided items kept on the context itself, as a
+    volatile attribute; it is discarded with the object (and the connection
+    that loaded it), so nothing is pinned across connections.
+    """
+    cache = getattr(context, '_v_completable_items_cache', None)
+    if cache is None and create:
+        cache = _LRUCache(maxsize=100)
+        try:
+            context._v_completable_items_cache = cache
+        except AttributeError:  # pragma: no cover
+            return None
+    return cache
+
+
+def _completable_items_cache_key(provider_iface, user, context):
+    user_id = getattr(user, 'username', None) or getattr(user, 'id', None)
+    if not user_id or not getattr(context, 'ntiid', None):
+        return None
+    # Do not adapt here, that would create (and store) the annotations
+    # merely to compute a key.
+    required_stamp = _version_stamp(
+        _query_annotation(context, COMPLETABLE_ITEM_ANNOTATION_KEY))
+    policy_stamp = _version_stamp(
+        _query_annotation(context, COMPLETABLE_ITEM_DEFAULT_REQUIRED_ANNOTATION_KEY))
+    if required_stamp is None or policy_stamp is None:
+        return None
+    return (provider_iface, user_id,
+            getattr(context, 'lastModified', None),
+            required_stamp, policy_stamp, _completable_items_generation)
+
+
+def invalidate_completable_items_cache(context=None, user=None):
+    """
+    Invalidate the cached completable and required items, for the given
+    context and/or user if given, or all of them otherwise.
+    """
+    global _completable_items_generation
+    if context is None:
+        # The caches live on the contexts; outdate all of them
+        _completable_items_generation += 1
+        return
+    cache = _completable_items_cache(context)
+    if cache is None:
+        return
+    if user is None:
+        cache.invalidate()
+        return
+    user_id = getattr(user, 'username', None) or getattr(user, 'id', user)
+    cache.invalidate(lambda key: key[1] == user_id)
+
+
+def _get_provided_items(provider_iface, user, context, timings=None,
+                        use_cache=False):
+    key = None
+    if use_cache:
+        key = _completable_items_cache_key(provider_iface, user, context)
+        cache = _completable_items_cache(context)
+        cached = cache.get(key) if key is not None and cache is not None else None
+        if cached is not None:
+            return set(cached)
+
+    result = set(_iter_provided_items(provider_iface, user, context, timings))
+    if key is not None:
+        cache = _completable_items_cache(context, create=True)
+        if cache is not None:
+            cache.set(key, frozenset(result))
+    return result
+
+
+def iter_completable_items_for_user(user, context, timings=None):
+    """
+    Lazily yield the de-duplicated possible :class:`ICompletedItem` for the
+    given context and user.
+    :param user: the user who has updated progress on the item
+    :param context: the :class:`ICompletionContext`
+    :param timings: an optional dict to be populated with the seconds spent
+        in each :class:`ICompletableItemProvider`
+    """
+    return _iter_provided_items(ICompletableItemProvider, user, context,
+                                timings)
+
+
+def iter_required_completable_items_for_user(user, context, timings=None):
+    """
+    Lazily yield the de-duplicated required :class:`ICompletedItem` for the
+    given context and user.
+    :param user: the user who has updated progress on the item
+    :param context: the :class:`ICompletionContext`
+    :param timings: an optional dict to be populated with the seconds spent
+        in each :class:`IRequiredCompletableItemProvider`
+    """
+    return _iter_provided_items(IRequiredCompletableItemProvider, user, context,
+                                timings)
+
+
+def get_completable_items_for_user(user, context, timings=None,
+                                   use_cache=False):
     """
     Return the possible :class:`ICompletedItem` for the given context and user.
     :param user: the user who has updated progress on the item
     :param context: the :class:`ICompletionContext`
+    :param timings: an optional dict to be populated with the seconds spent
+        in each :class:`ICompletableItemProvider`
+    :param use_cache: if True, the result is cached (per user, context
+        NTIID and last modified, and required state) in a bounded LRU
+        cache. See :func:`invalidate_completable_items_cache`.
     """
-    result = set()
-    item_providers = component.subscribers((context,),
-                                           ICompletableItemProvider)
-    for item_provider in item_providers:
-        completable_items = item_provider.iter_items(user)
-        result.update(completable_items)
-    return result
+    return _get_provided_items(ICompletableItemProvider, user, context,
+                               timings, use_cache)
 
 
-def get_required_completable_items_for_user(user, context):
+def get_required_completable_items_for_user(user, context, timings=None,
+                                            use_cache=False):
     """
     Return the required :class:`ICompletedItem` for the given context and user.
     :param user: the user who has updated progress on the item
     :param context: the :class:`ICompletionContext`
+    :param timings: an optional dict to be populated with the seconds spent
+        in each :class:`IRequiredCompletableItemProvider`
+    :param use_cache: if True, the result is cached. See
+        :func:`get_completable_items_for_user`.
     """
-    result = set()
-    item_providers = component.subscribers((context,),
-                                           IRequiredCompletableItemProvider)
-    for item_provider in item_providers:
-        completable_items = item_provider.iter_items(user)
-        result.update(completable_items)
-    return result
+    return _get_provided_items(IRequiredCompletableItemProvider, user, context,
+                               timings, use_cache)
 
 
 def get_indexed_completed_items_intids(users=(), contexts=(), items=(), sites=(),
@@ -226,6 +615,8 @@ def get_indexed_completed_items_intids(users=(), contexts=(), items=(), sites=()
     query = {}
     result = []
     catalog = get_completed_item_catalog() if catalog is None else catalog
+    # Read our own queued writes
+    flush_completed_item_indexing_queue(catalog)
 
     # process users/principals
     if users:
@@ -243,8 +634,11 @@ def get_indexed_completed_items_intids(users=(), contexts=(), items=(), sites=()
             sites = sites.split(',')
     elif getSite() is not None:
         sites = get_component_hierarchy_names()
+    site_intids = None
     if sites:
-        query[IX_SITE] = {'any_of': sites}
+        site_intids = _get_site_intids(catalog, sites)
+        if site_intids is None:
+            query[IX_SITE] = {'any_of': sites}
 
     # process context and items
     for values, index in ((contexts, IX_CONTEXT_NTIID),
@@ -263,16 +657,465 @@ def get_indexed_completed_items_intids(users=(), contexts=(), items=(), sites=()
     if success is not None:
         query[IX_SUCCESS] = {'any_of': (success,)}
 
-    if query:
-        result = catalog.apply(query)
+    _use_item_success_index(catalog, query)
+    _use_context_principal_index(catalog, query)
+    if query or site_intids is not None:
+        result = _apply_query(catalog, query, site_intids)
     return result
 
 
-def get_indexed_completed_items(users=None, intids=None, *args, **kwargs):
+def _get_site_intids(catalog, sites):
     """
-    Return the reified result set of completed items according to the parameters.
+    Return the union of the intids indexed for the given sites, cached until
+    the site index records a change, or None if it cannot be cached.
+
+    The cache is kept on the site index itself as a volatile attribute, so
+    it belongs to the connection that loaded the index.
+    """
+    index = catalog[IX_SITE]
+    changes = getattr(index, 'changes', None)
+    if changes is None or getattr(changes, '_p_changed', False):
+        # Legacy index or changed in this transaction
+        return None
+    stamp = (changes(), getattr(changes, '_p_serial', None))
+    cache = getattr(index, '_v_site_intids', None)
+    if cache is None or cache[0] != stamp:
+        cache = index._v_site_intids = (stamp, _LRUCache(maxsize=100))
+    sites = tuple(sorted(set(sites)))
+    result = cache[1].get(sites)
+    if result is None:
+        family = getattr(catalog, 'family', BTrees.family64)
+        values_to_documents = index.values_to_documents
+        result = family.IF.multiunion([values_to_documents[x]
+                                       for x in sites if x in values_to_documents])
+        cache[1].set(sites, result)
+    return result
+
+
+def invalidate_site_intids_cache(catalog=None):
+    """
+    Drop the cached site intid sets of the given (or the current) catalog.
+    """
+    catalog = get_completed_item_catalog() if catalog is None else catalog
+    index = catalog.get(IX_SITE) if catalog is not None else None
+    try:
+        del index._v_site_intids
+    except AttributeError:
+        pass
+
+
+def _use_item_success_index(catalog, query):
+    """
+    Replace the item and success terms of the given query with a single
+    term on the composite (item, success) index, when available.
     """
+    if      IX_ITEM_NTIID not in query \
+        or IX_SUCCESS not in query \
+        or not is_index_populated(catalog, IX_ITEM_SUCCESS):
+        return query
+    items = query.pop(IX_ITEM_NTIID)['any_of']
+    success = [bool(x) for x in query.pop(IX_SUCCESS)['any_of']]
+    query[IX_ITEM_SUCCESS] = {
+        'any_of': [(item, value) for item in items for value in success]
+    }
+    return query
+
+
+#: The largest (context, principal) cross product looked up through the
+#: composite index rather than intersecting the two single-valued indexes.
+_MAX_CONTEXT_PRINCIPAL_KEYS = 1000
+
+
+def _use_context_principal_index(catalog, query):
+    """
+    Replace the context and principal terms of the given query with a single
+    term on the composite (context, principal) index, when available.
+    """
+    if      IX_PRINCIPAL not in query \
+        or IX_CONTEXT_NTIID not in query \
+        or not is_index_populated(catalog, IX_CONTEXT_PRINCIPAL):
+        return query
+    users = query[IX_PRINCIPAL]['any_of']
+    contexts = query[IX_CONTEXT_NTIID]['any_of']
+    if len(users) * len(contexts) > _MAX_CONTEXT_PRINCIPAL_KEYS:
+        return query
+    query.pop(IX_PRINCIPAL)
+    query.pop(IX_CONTEXT_NTIID)
+    query[IX_CONTEXT_PRINCIPAL] = {
+        'any_of': [(context, user) for context in contexts for user in users]
+    }
+    return query
+
+
+#: A query term whose estimated size is this many times larger than the
+#: running result is checked document by document rather than materialized.
+_FILTER_RATIO = 10
+
+
+def _index_statistic(index, name):
+    statistic = getattr(index, name, None)
+    if statistic is None:
+        statistic = getattr(getattr(index, 'index', None), name, None)
+    return statistic() if statistic is not None else None
+
+
+def _estimate_term(index, term):
+    """
+    Estimate the number of documents matched by the query term from the
+    index statistics, without touching its documents.
+    """
+    documents = _index_statistic(index, 'documentCount')
+    if documents is None:
+        return sys.maxsize
+    values = term.get('any_of')
+    if values is None:
+        return documents
+    words = _index_statistic(index, 'wordCount')
+    if not words:
+        return 0 if words == 0 else documents
+    return documents * len(values) // words
+
+
+def _can_filter(index, term):
+    return  list(term) == ['any_of'] \
+        and getattr(index, 'documents_to_values', None) is not None
+
+
+def _apply_query(catalog, query, intids=None):
+    """
+    Apply the catalog query, evaluating the most selective terms first and
+    stopping as soon as the result is empty. Terms much larger than the
+    running result are checked against each of its documents instead of
+    being materialized.
+
+    :param intids: An optional, precomputed intid set the result is
+        restricted to.
+    """
+    family = getattr(catalog, 'family', BTrees.family64)
+    terms = [(_estimate_term(catalog[name], term), name, term)
+             for name, term in query.items()]
+    if intids is not None:
+        terms.append((len(intids), None, intids))
+    terms.sort(key=lambda x: x[0])
+    result = None
+    for estimate, name, term in terms:
+        if name is None:
+            result = term if result is None else family.IF.intersection(result, term)
+            if not result:
+                break
+            continue
+        index = catalog[name]
+        if      result is not None \
+            and len(result) * _FILTER_RATIO < estimate \
+            and _can_filter(index, term):
+            values = set(term['any_of'])
+            documents_to_values = index.documents_to_values
+            result = family.IF.Set([x for x in result
+                                    if documents_to_values.get(x) in values])
+        else:
+            rs = index.apply(term)
+            if rs is None:
+                continue
+            result = rs if result is None else family.IF.intersection(result, rs)
+        if not result:
+            break
+    if result is None:
+        result = family.IF.Set()
+    elif result is intids:
+        # Never hand out the (shared, cached) intid set itself
+        result = family.IF.Set(result)
+    return result
+
+
+def count_indexed_completed_items(*args, **kwargs):
+    """
+    Return the number of indexed completed items according to the parameters
+    (see :func:`get_indexed_completed_items_intids`), without loading any
+    of them.
+    """
+    return len(get_indexed_completed_items_intids(*args, **kwargs))
+
+
+def _count_indexed_completed_items_by(index_name, catalog=None, **kwargs):
+    """
+    Return a dict of index value -> number of indexed completed items
+    matching the parameters, computed from the index data structures.
+    """
+    catalog = get_completed_item_catalog() if catalog is None else catalog
+    rs = get_indexed_completed_items_intids(catalog=catalog, **kwargs)
+    if not rs:
+        return {}
+    family = getattr(catalog, 'family', BTrees.family64)
+    return _count_index_values(catalog[index_name], rs, family)
+
+
+#: Only indexes with at most this many distinct values (e.g. success or
+#: item indexes) are counted by intersecting each value's documents with
+#: the result set; others are counted with a lookup per document.
+_INTERSECT_MAX_VALUES = 32
+
+
+def _count_index_values(index, rs, family=BTrees.family64):
+    """
+    Return a dict of index value -> number of documents of the given
+    result set (or of the whole index if None) indexed with that value.
+    """
+    result = {}
+    word_count = getattr(index, 'wordCount', None)
+    word_count = word_count() if word_count is not None else None
+    if rs is None:
+        for value, docids in index.values_to_documents.items():
+            result[value] = len(docids)
+    elif     word_count is not None \
+         and word_count <= _INTERSECT_MAX_VALUES \
+         and word_count <= len(rs):
+        # Few distinct values, intersect each of them with our result set
+        for value, docids in index.values_to_documents.items():
+            count = len(family.IF.intersection(docids, rs))
+            if count:
+                result[value] = count
+    else:
+        documents_to_values = index.documents_to_values
+        for docid in rs:
+            value = documents_to_values.get(docid)
+            if value is not None:
+                result[value] = result.get(value, 0) + 1
+    return result
+
+
+def count_indexed_completed_items_by_principal(**kwargs):
+    """
+    Return a dict of principal id -> number of indexed completed items
+    according to the parameters of :func:`get_indexed_completed_items_intids`.
+    """
+    return _count_indexed_completed_items_by(IX_PRINCIPAL, **kwargs)
+
+
+def count_indexed_completed_items_by_item(**kwargs):
+    """
+    Return a dict of item ntiid -> number of indexed completed items
+    according to the parameters of :func:`get_indexed_completed_items_intids`.
+    """
+    return _count_indexed_completed_items_by(IX_ITEM_NTIID, **kwargs)
+
+
+def count_indexed_completed_items_by_context(**kwargs):
+    """
+    Return a dict of context ntiid -> number of indexed completed items
+    according to the parameters of :func:`get_indexed_completed_items_intids`.
+    """
+    return _count_indexed_completed_items_by(IX_CONTEXT_NTIID, **kwargs)
+
+
+def count_indexed_completed_items_by_success(items, catalog=None, **kwargs):
+    """
+    Return a dict of item ntiid -> (success count, failure count) for the
+    given items, read from the (item, success) index postings and restricted
+    to the remaining parameters of :func:`get_indexed_completed_items_intids`.
+    """
+    result = {}
+    catalog = get_completed_item_catalog() if catalog is None else catalog
+    if isinstance(items, six.string_types):
+        items = items.split(',')
+    items = {getattr(x, 'ntiid', x) for x in items}
+    if not is_index_populated(catalog, IX_ITEM_SUCCESS):
+        for success in (True, False):
+            counts = _count_indexed_completed_items_by(IX_ITEM_NTIID,
+                                                       catalog=catalog,
+                                                       items=items,
+                                                       success=success,
+                                                       **kwargs)
+            for ntiid, count in counts.items():
+                pair = result.setdefault(ntiid, [0, 0])
+                pair[0 if success else 1] = count
+        return {k: tuple(v) for k, v in result.items()}
+
+    rs = None
+    if kwargs or getSite() is not None:
+        rs = get_indexed_completed_items_intids(catalog=catalog, **kwargs)
+        if not rs:
+            return result
+    family = getattr(catalog, 'family', BTrees.family64)
+    values_to_documents = catalog[IX_ITEM_SUCCESS].values_to_documents
+    for ntiid in items:
+        counts = []
+        for success in (True, False):
+            docids = values_to_documents.get((ntiid, success))
+            if docids and rs is not None:
+                docids = family.IF.intersection(docids, rs)
+            counts.append(len(docids) if docids else 0)
+        if any(counts):
+            result[ntiid] = tuple(counts)
+    return result
+
+
+def get_indexed_completion_histogram(catalog=None, **kwargs):
+    """
+    Return a dict of day -> number of indexed completed items according to
+    the parameters of :func:`get_indexed_completed_items_intids`, computed
+    from the completion by day index without loading any completed item.
+    Days are the (float) timestamps of their start, as normalized by the
+    index.
+    """
+    catalog = get_completed_item_catalog() if catalog is None else catalog
+    rs = None
+    if kwargs or getSite() is not None:
+        rs = get_indexed_completed_items_intids(catalog=catalog, **kwargs)
+        if not rs:
+            return {}
+    wrapper = catalog[IX_COMPLETION_BY_DAY]
+    index = getattr(wrapper, 'index', wrapper)
+    family = getattr(catalog, 'family', BTrees.family64)
+    counts = _count_index_values(index, rs, family)
+    # The index stores the day timestamps encoded as 64-bit integers
+    return {bit64_int_to_number(day): count for day, count in counts.items()}
+
+
+#: When a result set is this many times smaller than the completion time
+#: index, it is sorted in memory rather than by walking the index.
+_SORT_IN_MEMORY_RATIO = 10
+
+
+def _sort_rows_in_memory(rs, index, reverse, cursor, limit):
+    rows = []
+    documents_to_values = index.documents_to_values
+    for docid in rs:
+        value = documents_to_values.get(docid)
+        if value is None:
+            continue
+        row = (value, docid)
+        if cursor is None or (row < cursor if reverse else row > cursor):
+            rows.append(row)
+    if limit is not None:
+        select = heapq.nlargest if reverse else heapq.nsmallest
+        return select(limit, rows)
+    return sorted(rows, reverse=reverse)
+
+
+def _walk_sorted_rows(rs, index, family, reverse, cursor):
+    values_to_documents = index.values_to_documents
+    if reverse:
+        value = cursor[0] if cursor is not None else None
+        while True:
+            try:
+                if value is None:
+                    value = values_to_documents.maxKey()
+                else:
+                    value = values_to_documents.maxKey(value)
+            except ValueError:
+                break
+            docids = family.IF.intersection(values_to_documents[value], rs)
+            for docid in reversed(list(docids or ())):
+                if cursor is None or (value, docid) < cursor:
+                    yield value, docid
+            value -= 1
+    else:
+        min_value = cursor[0] if cursor is not None else None
+        for value, docids in values_to_documents.items(min_value):
+            docids = family.IF.intersection(docids, rs)
+            for docid in docids or ():
+                if cursor is None or (value, docid) > cursor:
+                    yield value, docid
+
+
+def get_sorted_indexed_completed_items_intids(limit=None, reverse=True,
+                                              cursor=None, catalog=None,
+                                              **kwargs):
+    """
+    Return the intids of completed items according to the parameters of
+    :func:`get_indexed_completed_items_intids`, sorted by completion time,
+    using the completion time index.
+
+    :param limit: the maximum number of intids to return
+    :param reverse: if True (the default) the most recent completions come
+        first
+    :param cursor: the cursor returned by a previous call, to fetch the next
+        page
+    :return: a tuple of the list of intids and the cursor for the next page
+        (or None if there are no more results)
+    """
+    catalog = get_completed_item_catalog() if catalog is None else catalog
+    rs = get_indexed_completed_items_intids(catalog=catalog, **kwargs)
+    if not rs:
+        return [], None
+    cursor = tuple(cursor) if cursor is not None else None
+    index = catalog[IX_COMPLETIONTIME]
+    index = getattr(index, 'index', index)
+    document_count = getattr(index, 'documentCount', None)
+    if      document_count is not None \
+        and len(rs) * _SORT_IN_MEMORY_RATIO < document_count():
+        rows = _sort_rows_in_memory(rs, index, reverse, cursor, limit)
+    else:
+        family = getattr(catalog, 'family', BTrees.family64)
+        rows = _walk_sorted_rows(rs, index, family, reverse, cursor)
+        rows = list(itertools.islice(rows, limit))
+    next_cursor = None
+    if limit is not None and rows and len(rows) == limit:
+        next_cursor = rows[-1]
+    return [docid for _, docid in rows], next_cursor
+
+
+def _prefetch(objects):
+    """
+    Ask the database to load the state of the given persistent objects in
+    as few round trips as the storage allows.
+    """
+    connections = {}
+    for obj in objects:
+        connection = getattr(obj, '_p_jar', None)
+        if connection is not None:
+            connections.setdefault(id(connection), (connection, []))[1].append(obj)
+    for connection, batch in connections.values():
+        prefetch = getattr(connection, 'prefetch', None)
+        if prefetch is not None:
+            try:
+                prefetch(batch)
+            except Exception:  # pylint: disable=broad-except
+                logger.debug('Cannot prefetch completed items', exc_info=True)
+
+
+def iter_indexed_completed_items(users=None, intids=None, *args, **kwargs):
+    """
+    Yield the reified completed items according to the parameters, loading
+    (and prefetching) them in batches so that memory use is bounded.
+
+    In addition to the parameters of
+    :func:`get_indexed_completed_items_intids`, accepts:
+
+    :keyword batch_size: the number of objects to load at a time
+    :keyword offset: the number of matching intids to skip
+    :keyword limit: the maximum number of intids to consider
+    """
+    batch_size = kwargs.pop('batch_size', 100)
+    offset = kwargs.pop('offset', 0)
+    limit = kwargs.pop('limit', None)
     intids = component.getUtility(IIntIds) if intids is None else intids
     rs = get_indexed_completed_items_intids(users=users, *args, **kwargs)
-    items = (intids.queryObject(x) for x in rs)
-    return [x for x in items if ICompletedItem.providedBy(x)]
+    stop = offset + limit if limit is not None else None
+    docids = iter(itertools.islice(rs, offset, stop))
+    while True:
+        batch = [intids.queryObject(x) for x in itertools.islice(docids, batch_size)]
+        if not batch:
+            break
+        # Prefetch the ghosts before anything (even an interface check)
+        # loads their state one at a time.
+        batch = [x for x in batch if x is not None]
+        _prefetch(batch)
+        for item in batch:
+            if ICompletedItem.providedBy(item):
+                yield item
+
+
+def get_indexed_completed_items(users=None, intids=None, *args, **kwargs):
+    """
+    Return the reified result set of completed items according to the parameters.
+    """
+    return list(iter_indexed_completed_items(users, intids, *args, **kwargs))
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(invalidate_completable_items_cache)